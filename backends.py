@@ -0,0 +1,196 @@
+"""
+LLM backends selected by configuration (LLM_BACKEND).
+
+- "openai": the live ChatOpenAI client.
+- "record": the live client, plus every completed call is appended to a
+  JSONL file: the prompt, the request shape (structured output schema or
+  plain text) and each streamed chunk with its offset from the request start.
+- "replay": no network calls. Requests are answered from a recording with
+  the original chunk timing (scaled by LLM_REPLAY_TIME_SCALE, 0 = instant),
+  so the full pipeline, callbacks and token streams behave as they did live.
+
+Replay matches a request by its prompt and shape. Unless LLM_REPLAY_STRICT
+is set, a request with no exact match (e.g. a load test with generated
+names) is answered from a recording of the same shape, picked by the prompt
+hash so repeated runs are deterministic.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from functools import reduce
+from typing import Any, Dict, List
+import orjson
+from langchain_core.messages import AIMessageChunk, BaseMessage, message_chunk_to_message
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_openai import ChatOpenAI
+from pydantic import PrivateAttr
+from serialization import dumps
+
+BACKENDS = ("openai", "record", "replay")
+
+
+def request_shape(kwargs: Dict[str, Any]) -> str:
+    """Structured output schema (or tool) a request asks for; "text" for plain completions."""
+    response_format = kwargs.get("response_format")
+    if isinstance(response_format, type):
+        return response_format.__name__
+    if isinstance(response_format, dict):
+        return response_format.get("json_schema", {}).get("name") or response_format.get("type", "text")
+    tools = kwargs.get("tools") or []
+    if tools:
+        return ",".join(sorted(str(tool.get("function", {}).get("name", "tool")) for tool in tools))
+    return "text"
+
+
+def request_key(messages: List[BaseMessage], shape: str) -> str:
+    prompt = dumps([shape] + [[message.type, message.content] for message in messages])
+    return hashlib.sha256(prompt).hexdigest()
+
+
+def _message_dict(message) -> dict:
+    """JSON-safe fields needed to rebuild a message as an AIMessageChunk."""
+    if isinstance(message, AIMessageChunk):
+        tool_call_chunks = list(message.tool_call_chunks)
+    else:
+        # Non-streamed message: store its tool calls in chunk form
+        tool_call_chunks = [
+            {"name": call["name"], "args": json.dumps(call["args"]), "id": call.get("id"), "index": i}
+            for i, call in enumerate(getattr(message, "tool_calls", None) or [])
+        ]
+    return orjson.loads(dumps({
+        "content": message.content,
+        # "parsed" (a Pydantic model) is stored as a dict; the parser accepts both
+        "additional_kwargs": message.additional_kwargs,
+        "tool_call_chunks": tool_call_chunks,
+        "usage_metadata": getattr(message, "usage_metadata", None),
+        "response_metadata": message.response_metadata,
+    }))
+
+
+# ----------------------
+# Record
+# ----------------------
+_write_lock = asyncio.Lock()
+
+
+async def flush_recordings() -> None:
+    """Wait for recordings queued for writing (the lock is handed out in order)."""
+    async with _write_lock:
+        pass
+
+
+class RecordingChatOpenAI(ChatOpenAI):
+    record_path: str
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        started = time.perf_counter()
+        chunks = []
+        async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            chunks.append({"t": round(time.perf_counter() - started, 4), "message": _message_dict(chunk.message)})
+            yield chunk
+        # Only complete calls are recorded; a cancelled stream never gets here
+        await self._record(messages, kwargs, chunks)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        started = time.perf_counter()
+        result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        chunks = [{
+            "t": round(time.perf_counter() - started, 4),
+            "message": _message_dict(result.generations[0].message)
+        }]
+        await self._record(messages, kwargs, chunks)
+        return result
+
+    async def _record(self, messages: List[BaseMessage], kwargs: Dict[str, Any], chunks: List[dict]) -> None:
+        shape = request_shape(kwargs)
+        line = dumps({
+            "key": request_key(messages, shape),
+            "shape": shape,
+            "model": self.model_name,
+            "recorded_at": time.time(),
+            "messages": [{"type": message.type, "content": message.content} for message in messages],
+            "chunks": chunks,
+        }) + b"\n"
+        async with _write_lock:
+            await asyncio.to_thread(self._append, line)
+
+    def _append(self, line: bytes) -> None:
+        directory = os.path.dirname(self.record_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.record_path, "ab") as f:
+            f.write(line)
+
+
+# ----------------------
+# Replay
+# ----------------------
+class ReplayChatOpenAI(ChatOpenAI):
+    record_path: str
+    time_scale: float = 1.0
+    strict: bool = False
+
+    _by_key: Dict[str, List[dict]] = PrivateAttr(default_factory=dict)
+    _by_shape: Dict[str, List[dict]] = PrivateAttr(default_factory=dict)
+    _served: Dict[str, int] = PrivateAttr(default_factory=dict)
+
+    def load(self) -> None:
+        with open(self.record_path, "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = orjson.loads(line)
+                self._by_key.setdefault(record["key"], []).append(record)
+                self._by_shape.setdefault(record["shape"], []).append(record)
+
+    def lookup(self, messages: List[BaseMessage], kwargs: Dict[str, Any]) -> dict:
+        shape = request_shape(kwargs)
+        key = request_key(messages, shape)
+        records = self._by_key.get(key)
+        if records:
+            # Repeated requests cycle through every recording of them
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+            return records[served % len(records)]
+        if self.strict or not self._by_shape.get(shape):
+            raise LookupError(f"No recorded {shape} response for this prompt in {self.record_path}")
+        records = self._by_shape[shape]
+        return records[int(key, 16) % len(records)]
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        record = self.lookup(messages, kwargs)
+        started = time.perf_counter()
+        for item in record["chunks"]:
+            # sleep(0) still yields to the loop when replaying instantly
+            await asyncio.sleep(max(started + item["t"] * self.time_scale - time.perf_counter(), 0))
+            chunk = ChatGenerationChunk(message=AIMessageChunk(**item["message"]))
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        record = self.lookup(messages, kwargs)
+        await asyncio.sleep(record["chunks"][-1]["t"] * self.time_scale)
+        merged = reduce(lambda a, b: a + b, (AIMessageChunk(**item["message"]) for item in record["chunks"]))
+        return ChatResult(
+            generations=[ChatGeneration(message=message_chunk_to_message(merged))],
+            llm_output={"model_name": record.get("model")}
+        )
+
+
+def create_llm(backend: str, record_path: str, time_scale: float = 1.0, strict: bool = False,
+               **chat_kwargs) -> ChatOpenAI:
+    """Chat model for the configured backend; chat_kwargs are passed to ChatOpenAI."""
+    if backend == "openai":
+        return ChatOpenAI(**chat_kwargs)
+    if backend == "record":
+        return RecordingChatOpenAI(record_path=record_path, **chat_kwargs)
+    if backend == "replay":
+        # The client is never used, but ChatOpenAI requires a key
+        chat_kwargs["openai_api_key"] = chat_kwargs.get("openai_api_key") or "replay"
+        llm = ReplayChatOpenAI(record_path=record_path, time_scale=time_scale, strict=strict, **chat_kwargs)
+        llm.load()
+        return llm
+    raise ValueError(f"Unknown LLM_BACKEND {backend!r}, expected one of {', '.join(BACKENDS)}")
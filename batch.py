@@ -0,0 +1,154 @@
+"""
+Class-level persona generation.
+
+Several students are packed into one LLM request so the instruction block
+and the round trip are paid once per pack instead of once per student. The
+pack size adapts to the output token budget using the output tokens
+actually observed per student. Results are split back per student and any
+student whose entry is missing or fails validation is retried on its own.
+Like the single-student path, the model only writes PersonaDrafts; the
+locally derived fields are merged in by build_persona_analysis.
+"""
+import asyncio
+import json
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, List, Optional
+from langchain_core.prompts import PromptTemplate
+from pydantic import ValidationError
+from models import StudentInfo, PersonaAnalysis, PersonaDraft, ClassPersonaAnalysis
+from utils import student_text, create_class_persona_prompt, build_persona_analysis
+from generation import generate_persona_analysis
+
+
+class PackSizer:
+    """Chooses how many students fit in one request's output token budget."""
+
+    def __init__(self, max_output_tokens: int, max_pack_size: int,
+                 initial_tokens_per_student: int, headroom: float = 0.8, smoothing: float = 0.3):
+        self.max_output_tokens = max_output_tokens
+        self.max_pack_size = max_pack_size
+        self.tokens_per_student = float(initial_tokens_per_student)
+        self.headroom = headroom
+        self.smoothing = smoothing
+
+    def pack_size(self) -> int:
+        budget = self.max_output_tokens * self.headroom
+        return max(1, min(self.max_pack_size, int(budget // self.tokens_per_student)))
+
+    def observe(self, output_tokens: int, students: int) -> None:
+        # Exponential moving average, so one unusual response does not swing the size
+        per_student = output_tokens / students
+        self.tokens_per_student += self.smoothing * (per_student - self.tokens_per_student)
+
+
+def _raw_payload(raw) -> Optional[Any]:
+    """JSON payload of a structured-output message, whichever method produced it."""
+    if raw is None:
+        return None
+    if raw.tool_calls:
+        return raw.tool_calls[0]["args"]
+    parsed = raw.additional_kwargs.get("parsed")
+    if parsed is not None:
+        return parsed.model_dump() if hasattr(parsed, "model_dump") else parsed
+    if isinstance(raw.content, str) and raw.content:
+        try:
+            return json.loads(raw.content)
+        except json.JSONDecodeError:
+            return None
+    return None
+
+
+class ClassPersonaGenerator:
+    def __init__(self, llm, sizer: PackSizer, concurrency: int,
+                 slot: Optional[Callable[[StudentInfo, str], Any]] = None):
+        self.llm = llm
+        self.sizer = sizer
+        self.concurrency = concurrency
+        # slot(student, priority) -> async context held around each LLM request
+        self.slot = slot or (lambda student, priority: nullcontext())
+        self.stats = {"packs": 0, "packed_students": 0, "fallbacks": 0}
+
+    async def generate(self, students: List[StudentInfo], config: Optional[dict] = None
+                       ) -> List[Dict[str, Any]]:
+        """
+        Returns one result per student, in input order:
+        {"analysis": PersonaAnalysis | None, "source": "batch" | "individual", "error": str | None}
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results: List[Optional[Dict[str, Any]]] = [None] * len(students)
+
+        async def run_pack(indices: List[int]) -> None:
+            async with semaphore, self.slot(students[indices[0]], "bulk"):
+                parsed = await self._generate_pack([students[i] for i in indices], config)
+            retries = []
+            for position, index in enumerate(indices):
+                analysis = parsed.get(position)
+                if analysis is not None:
+                    results[index] = {"analysis": analysis, "source": "batch", "error": None}
+                else:
+                    retries.append(index)
+            await asyncio.gather(*(run_single(index) for index in retries))
+
+        async def run_single(index: int) -> None:
+            self.stats["fallbacks"] += 1
+            async with semaphore, self.slot(students[index], "bulk"):
+                try:
+                    analysis = await self._generate_single(students[index], config)
+                    results[index] = {"analysis": analysis, "source": "individual", "error": None}
+                except Exception as e:
+                    results[index] = {"analysis": None, "source": "individual", "error": str(e)}
+
+        size = self.sizer.pack_size()
+        packs = [list(range(start, min(start + size, len(students))))
+                 for start in range(0, len(students), size)]
+        await asyncio.gather(*(run_pack(pack) for pack in packs))
+        return results
+
+    async def _generate_pack(self, students: List[StudentInfo], config: Optional[dict]
+                             ) -> Dict[int, PersonaAnalysis]:
+        """Validated analyses by position in the pack; failures are simply absent."""
+        if len(students) == 1:
+            # Nothing to share; the individual path is the same request with a simpler schema
+            return {}
+
+        ids = [f"S{i + 1}" for i in range(len(students))]
+        prompt_str = create_class_persona_prompt(
+            [(student_id, student_text(s)) for student_id, s in zip(ids, students)]
+        )
+        chain = (
+            PromptTemplate.from_template("{prompt_str}")
+            | self.llm.with_structured_output(ClassPersonaAnalysis, include_raw=True)
+        )
+        self.stats["packs"] += 1
+        try:
+            output = await chain.ainvoke({"prompt_str": prompt_str}, config=config)
+        except Exception:
+            return {}
+
+        raw = output["raw"]
+        usage = getattr(raw, "usage_metadata", None)
+        if usage and usage.get("output_tokens"):
+            self.sizer.observe(usage["output_tokens"], len(students))
+
+        payload = _raw_payload(raw)
+        entries = payload.get("personas", []) if isinstance(payload, dict) else []
+        positions = {student_id: i for i, student_id in enumerate(ids)}
+
+        parsed: Dict[int, PersonaAnalysis] = {}
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            position = positions.get(str(entry.get("student_id", "")).strip("[] "))
+            if position is None or position in parsed:
+                continue
+            try:
+                draft = PersonaDraft.model_validate(entry.get("draft"))
+            except ValidationError:
+                continue
+            parsed[position] = build_persona_analysis(students[position], draft)
+        self.stats["packed_students"] += len(parsed)
+        return parsed
+
+    async def _generate_single(self, student: StudentInfo, config: Optional[dict]) -> PersonaAnalysis:
+        return await generate_persona_analysis(self.llm, student, config=config)
+
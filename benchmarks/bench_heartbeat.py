@@ -0,0 +1,140 @@
+"""
+CPU and memory cost of heartbeats for idle SSE streams.
+
+Holds N idle streams in one process and sends them keepalives for a while in
+one of three ways:
+
+- none:  no heartbeats (the cost of the idle streams themselves)
+- task:  one heartbeat task per stream, sleeping for the interval
+- wheel: HeartbeatScheduler, one task turning a timer wheel for all streams
+
+Each stream is served the way uvicorn serves /persona/stream/: a
+HeartbeatResponse (ASGI spec 2.3, so it also listens for the disconnect)
+whose body is the text stage's loop, consuming an event queue fed by an LLM
+task that has not produced its first token yet. --consumer poll uses the
+old 100 ms polling get instead of a blocking one.
+
+Sends go to an in-memory ASGI send, so only the serving and scheduling cost
+is measured. Memory is the Python heap allocated while setting the streams
+up (tracemalloc); CPU is process time over the run.
+
+Run from the project root:
+    python -m benchmarks.bench_heartbeat
+"""
+import argparse
+import asyncio
+import gc
+import time
+import tracemalloc
+from heartbeat import HeartbeatScheduler, HeartbeatResponse
+from serialization import SSE_HEARTBEAT
+
+SCOPE = {"type": "http", "asgi": {"version": "3.0", "spec_version": "2.3"}, "method": "GET"}
+BODY = {"type": "http.response.body", "body": SSE_HEARTBEAT, "more_body": True}
+
+
+async def run_mode(mode: str, streams: int, interval: float, duration: float, consumer: str) -> dict:
+    sent = 0
+    # Neither the LLM nor the client ever gets anywhere
+    never = asyncio.Event()
+
+    async def send(message) -> None:
+        nonlocal sent
+        if message["type"] == "http.response.body" and message.get("body"):
+            sent += 1
+
+    async def receive() -> dict:
+        await never.wait()
+        return {"type": "http.disconnect"}
+
+    async def text_stage():
+        # generate_text_stage waiting for the first token
+        event_queue = asyncio.Queue()
+
+        async def run_chain():
+            try:
+                await never.wait()
+            finally:
+                event_queue.put_nowait(("end", b""))
+
+        task = asyncio.create_task(run_chain())
+        try:
+            while True:
+                if consumer == "poll":
+                    try:
+                        event_type, frame = await asyncio.wait_for(event_queue.get(), timeout=0.1)
+                    except asyncio.TimeoutError:
+                        continue
+                else:
+                    event_type, frame = await event_queue.get()
+                if event_type == "end":
+                    break
+                yield frame
+        finally:
+            task.cancel()
+
+    async def per_stream_heartbeat() -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await send(BODY)
+
+    scheduler = HeartbeatScheduler(interval) if mode == "wheel" else None
+
+    gc.collect()
+    tracemalloc.start()
+    tasks = []
+    for _ in range(streams):
+        response = HeartbeatResponse(text_stage(), heartbeat=scheduler, media_type="text/event-stream")
+        tasks.append(asyncio.create_task(response(SCOPE, receive, send)))
+        if mode == "task":
+            tasks.append(asyncio.create_task(per_stream_heartbeat()))
+    # Let every stream start its response and reach its idle wait
+    for _ in range(3):
+        await asyncio.sleep(0)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    sent = 0
+    cpu_started, wall_started = time.process_time(), time.perf_counter()
+    await asyncio.sleep(duration)
+    cpu = time.process_time() - cpu_started
+    wall = time.perf_counter() - wall_started
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if scheduler:
+        await scheduler.stop()
+
+    return {
+        "memory_mb": memory / 1e6,
+        "bytes_per_stream": memory / streams,
+        "cpu_percent": 100 * cpu / wall,
+        "heartbeats": sent,
+        "us_per_heartbeat": 1e6 * cpu / sent if sent else 0.0,
+    }
+
+
+async def main(args) -> None:
+    print(f"{args.streams} idle streams ({args.consumer} consumer), heartbeat every {args.interval}s, "
+          f"{args.duration}s run")
+    # Warm up, so one-off allocations (imports, caches) are not counted against the first mode
+    await run_mode("wheel", 100, args.interval, 0.1, args.consumer)
+    baseline = None
+    for mode in ("none", "task", "wheel"):
+        result = await run_mode(mode, args.streams, args.interval, args.duration, args.consumer)
+        baseline = baseline or result
+        extra = result["memory_mb"] - baseline["memory_mb"]
+        print(f"  {mode:5} memory {result['memory_mb']:6.1f} MB ({result['bytes_per_stream']:5.0f} B/stream, "
+              f"+{extra:5.1f} MB for heartbeats) | cpu {result['cpu_percent']:5.1f}% | "
+              f"{result['heartbeats']} heartbeats, {result['us_per_heartbeat']:.1f} us each")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--streams", type=int, default=10_000)
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between heartbeats")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds to hold the streams")
+    parser.add_argument("--consumer", choices=["block", "poll"], default="block",
+                        help="how the stream waits on its event queue")
+    asyncio.run(main(parser.parse_args()))
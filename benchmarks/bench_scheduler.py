@@ -0,0 +1,76 @@
+"""
+Simulated bulk burst against the generation scheduler.
+
+One school submits a burst of generations at once while other schools keep
+submitting single interactive requests. Each generation holds its slot for
+a fixed service time (no LLM is called). Reports the wait of the other
+schools' requests with first come, first served slots versus FairScheduler,
+for a burst of interactive streams and for a bulk class request.
+
+Run from the project root:
+    python -m benchmarks.bench_scheduler
+"""
+import argparse
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from scheduling import FairScheduler
+from stats import percentiles
+
+
+class FifoSlots:
+    """Baseline: one shared semaphore, served in arrival order."""
+
+    def __init__(self, capacity: int):
+        self.semaphore = asyncio.Semaphore(capacity)
+
+    @asynccontextmanager
+    async def slot(self, tenant: str, priority: str = "interactive"):
+        async with self.semaphore:
+            yield
+
+
+async def scenario(slots, burst: int, burst_priority: str, others: int, interval: float,
+                   service: float) -> dict:
+    waits = {"burst": [], "others": []}
+
+    async def generation(tenant: str, priority: str, kind: str):
+        queued = time.perf_counter()
+        async with slots.slot(tenant, priority):
+            waits[kind].append(time.perf_counter() - queued)
+            await asyncio.sleep(service)
+
+    async def other_schools():
+        jobs = []
+        for i in range(others):
+            jobs.append(asyncio.create_task(generation(f"school-{i % 4}", "interactive", "others")))
+            await asyncio.sleep(interval)
+        await asyncio.gather(*jobs)
+
+    await asyncio.gather(
+        *(generation("bulk-school", burst_priority, "burst") for _ in range(burst)),
+        other_schools()
+    )
+    return {kind: percentiles(w, digits=3) for kind, w in waits.items()}
+
+
+async def main(args) -> None:
+    for burst_priority in ("interactive", "bulk"):
+        print(f"burst of {args.burst} {burst_priority} generations from one school, "
+              f"{args.others} interactive from others, capacity {args.capacity}")
+        for name, slots in (("fifo", FifoSlots(args.capacity)), ("fair", FairScheduler(args.capacity))):
+            result = await scenario(slots, args.burst, burst_priority, args.others,
+                                    args.interval, args.service)
+            print(f"  {name:5} others wait p50={result['others']['p50']:.3f}s "
+                  f"p95={result['others']['p95']:.3f}s max={result['others']['max']:.3f}s | "
+                  f"burst wait p95={result['burst']['p95']:.3f}s max={result['burst']['max']:.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--capacity", type=int, default=8)
+    parser.add_argument("--burst", type=int, default=200)
+    parser.add_argument("--others", type=int, default=40)
+    parser.add_argument("--interval", type=float, default=0.05, help="seconds between other requests")
+    parser.add_argument("--service", type=float, default=0.1, help="seconds each generation holds a slot")
+    asyncio.run(main(parser.parse_args()))
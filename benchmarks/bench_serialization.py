@@ -0,0 +1,120 @@
+"""
+Micro-benchmark for SSE frame encoding.
+
+Compares the per-event CPU cost of the original f-string + json.dumps frames
+with the pre-encoded byte frames from serialization.py.
+
+Run from the project root:
+    python -m benchmarks.bench_serialization
+"""
+import json
+import timeit
+from serialization import sse_data, sse_event, sse_token, HTMX_DONE, STAGE_STREAMING
+from models import PersonaAnalysis, LearningMethod
+
+TOKEN = " visual"
+SUMMARY = (
+    "Aisyah binti Ahmad is a female student in Form 4. She is currently studying in "
+    "SMK Taman Connaught. She likes Biology, Chemistry subjects. She studies daily."
+)
+ANALYSIS = PersonaAnalysis(
+    thinking_process="Step 1... " * 40,
+    student_persona="A curious and disciplined student. " * 10,
+    language_preference="Malay",
+    learning_methods=[
+        LearningMethod(
+            method_name=f"Method {i}",
+            rationale="Fits the student's analytical style. " * 4,
+            example="Explain osmosis to a friend in plain words. " * 3,
+            icon="🧠"
+        )
+        for i in range(6)
+    ]
+)
+DASHBOARD_HTML = '<div class="dashboard-grid">' + '<div class="card">persona</div>' * 50 + '</div>'
+
+
+# ----------------------
+# Before: f-strings and json.dumps
+# ----------------------
+def old_token():
+    return f"data: {json.dumps({'type': 'token', 'content': TOKEN, 'word_count': 42})}\n\n"
+
+
+def old_stage():
+    return f"data: {json.dumps({'type': 'stage', 'stage': 'streaming', 'message': 'Generating persona...'})}\n\n"
+
+
+def old_summary():
+    return f"data: {json.dumps({'type': 'summary', 'content': SUMMARY})}\n\n"
+
+
+def old_result():
+    return f"data: {json.dumps({'type': 'result', 'analysis': ANALYSIS.model_dump()})}\n\n"
+
+
+def old_htmx_token():
+    return f"event: token\ndata: {DASHBOARD_HTML}\n\n"
+
+
+def old_htmx_done():
+    return f"""event: done
+data: <div id="sse-connection-closed"></div>
+
+"""
+
+
+# ----------------------
+# After: serialization.py
+# ----------------------
+def new_token():
+    return sse_token(TOKEN, 42)
+
+
+def new_stage():
+    return STAGE_STREAMING
+
+
+def new_summary():
+    return sse_data({'type': 'summary', 'content': SUMMARY})
+
+
+def new_result():
+    return sse_data({'type': 'result', 'analysis': ANALYSIS})
+
+
+def new_htmx_token():
+    return sse_event("token", DASHBOARD_HTML)
+
+
+def new_htmx_done():
+    return HTMX_DONE
+
+
+CASES = [
+    ("token event", old_token, new_token),
+    ("stage event", old_stage, new_stage),
+    ("summary event", old_summary, new_summary),
+    ("PersonaAnalysis", old_result, new_result),
+    ("htmx dashboard", old_htmx_token, new_htmx_token),
+    ("htmx done", old_htmx_done, new_htmx_done),
+]
+
+
+def _per_call_ns(fn, number: int) -> float:
+    # Best of 5 repeats to reduce noise from other processes
+    best = min(timeit.repeat(fn, number=number, repeat=5))
+    return best / number * 1e9
+
+
+def main(number: int = 20000):
+    print(f"{'event':<18}{'before (ns)':>14}{'after (ns)':>14}{'speedup':>10}")
+    for label, old, new in CASES:
+        # Old frames were str and had to be encoded by the response
+        before = _per_call_ns(lambda: old().encode("utf-8"), number)
+        after = _per_call_ns(new, number)
+        print(f"{label:<18}{before:>14.0f}{after:>14.0f}{before / after:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
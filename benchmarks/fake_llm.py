@@ -0,0 +1,185 @@
+"""
+Local fake of the OpenAI Chat Completions API for load testing.
+
+Serves deterministic completions with configurable latency so the full
+persona pipeline can be exercised without calling (or paying for) OpenAI.
+Structured output requests (response_format json_schema or tools) are
+answered with a JSON document generated from the requested schema.
+
+Run it next to the app and point the OpenAI client at it:
+    uvicorn benchmarks.fake_llm:app --port 8001
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=fake uvicorn main:app
+
+Latency knobs (environment variables):
+    FAKE_LLM_TTFT            seconds before the first token (default 0.5)
+    FAKE_LLM_TOKEN_INTERVAL  seconds between tokens (default 0.01)
+    FAKE_LLM_TOKEN_CHARS     characters per streamed token (default 4)
+    FAKE_LLM_ARRAY_ITEMS     items generated for array fields (default 6)
+"""
+import asyncio
+import os
+import time
+import uuid
+from typing import Any, Optional
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+from serialization import dumps
+
+TTFT = float(os.getenv("FAKE_LLM_TTFT", "0.5"))
+TOKEN_INTERVAL = float(os.getenv("FAKE_LLM_TOKEN_INTERVAL", "0.01"))
+TOKEN_CHARS = int(os.getenv("FAKE_LLM_TOKEN_CHARS", "4"))
+ARRAY_ITEMS = int(os.getenv("FAKE_LLM_ARRAY_ITEMS", "6"))
+
+PLAIN_TEXT = (
+    "This student is curious and methodical, enjoys connecting ideas across subjects "
+    "and responds well to short, focused study sessions with regular review. "
+) * 6
+SENTENCE = "A short generated sentence used by the fake LLM server for load testing."
+
+app = FastAPI()
+
+
+# ----------------------
+# Schema-driven fake output
+# ----------------------
+def _resolve(schema: dict, root: dict) -> dict:
+    ref = schema.get("$ref")
+    if ref:
+        # Only local refs ("#/$defs/Name") are produced by Pydantic
+        node: Any = root
+        for part in ref.lstrip("#/").split("/"):
+            node = node[part]
+        return node
+    return schema
+
+
+def fake_instance(schema: dict, root: Optional[dict] = None, name: str = "", index: int = 0) -> Any:
+    """Build a value that validates against a (Pydantic-generated) JSON schema."""
+    root = root or schema
+    schema = _resolve(schema, root)
+
+    if "anyOf" in schema:
+        options = [s for s in schema["anyOf"] if s.get("type") != "null"]
+        return fake_instance(options[0], root, name, index) if options else None
+    if "enum" in schema:
+        return schema["enum"][index % len(schema["enum"])]
+
+    kind = schema.get("type")
+    if kind == "object" or "properties" in schema:
+        return {
+            key: fake_instance(sub, root, key, index)
+            for key, sub in schema.get("properties", {}).items()
+        }
+    if kind == "array":
+        count = max(schema.get("minItems", ARRAY_ITEMS), 1)
+        count = min(count, schema.get("maxItems", count))
+        return [fake_instance(schema.get("items", {}), root, name, i) for i in range(count)]
+    if kind == "integer":
+        return 1
+    if kind == "number":
+        return 1.0
+    if kind == "boolean":
+        return True
+    if name == "icon":
+        return "🧠"
+    if name == "student_id":
+        # Class requests label students S1, S2, ...
+        return f"S{index + 1}"
+    return f"{name.replace('_', ' ').capitalize()}: {SENTENCE}" if name else SENTENCE
+
+
+def _structured_request(body: dict) -> tuple[Optional[dict], Optional[str]]:
+    """Return (schema, tool_name) if the request asks for structured output."""
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        return response_format["json_schema"]["schema"], None
+
+    for tool in body.get("tools") or []:
+        function = tool.get("function", {})
+        return function.get("parameters", {}), function.get("name")
+    return None, None
+
+
+def _prompt_tokens(body: dict) -> int:
+    # Rough 4-characters-per-token estimate
+    chars = sum(len(str(m.get("content", ""))) for m in body.get("messages", []))
+    return max(chars // 4, 1)
+
+
+# ----------------------
+# Chat Completions endpoint
+# ----------------------
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "fake-model")
+    schema, tool_name = _structured_request(body)
+    text = dumps(fake_instance(schema)).decode("utf-8") if schema else PLAIN_TEXT
+
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+    usage = {
+        "prompt_tokens": _prompt_tokens(body),
+        "completion_tokens": max(len(text) // TOKEN_CHARS, 1),
+    }
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+    finish_reason = "tool_calls" if tool_name else "stop"
+
+    def chunk(delta: dict, finish: Optional[str] = None) -> bytes:
+        return b"data: " + dumps({
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+        }) + b"\n\n"
+
+    def delta_for(piece: str, first: bool) -> dict:
+        if tool_name:
+            call = {"index": 0, "function": {"arguments": piece}}
+            if first:
+                call.update({"id": f"call_{completion_id}", "type": "function"})
+                call["function"]["name"] = tool_name
+            return {"tool_calls": [call]}
+        return {"content": piece}
+
+    if not body.get("stream"):
+        await asyncio.sleep(TTFT + TOKEN_INTERVAL * usage["completion_tokens"])
+        message: dict = {"role": "assistant", "content": None if tool_name else text}
+        if tool_name:
+            message["tool_calls"] = [{
+                "id": f"call_{completion_id}",
+                "type": "function",
+                "function": {"name": tool_name, "arguments": text},
+            }]
+        return Response(dumps({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": usage,
+        }), media_type="application/json")
+
+    include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+    async def stream():
+        yield chunk({"role": "assistant", "content": "" if not tool_name else None})
+        await asyncio.sleep(TTFT)
+        for i in range(0, len(text), TOKEN_CHARS):
+            yield chunk(delta_for(text[i:i + TOKEN_CHARS], i == 0))
+            if TOKEN_INTERVAL:
+                await asyncio.sleep(TOKEN_INTERVAL)
+        yield chunk({}, finish_reason)
+        if include_usage:
+            yield b"data: " + dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [],
+                "usage": usage,
+            }) + b"\n\n"
+        yield b"data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
@@ -0,0 +1,418 @@
+"""
+asyncio load generator for the persona SSE endpoints.
+
+Opens many concurrent SSE sessions against either flow:
+    stream  POST /persona/stream/
+    htmx    GET /persona/htmx-setup -> GET /persona/stream-htmx?ticket=...
+
+Arrival models:
+    closed  --concurrency N virtual users, each starting a new session as soon
+            as the previous one ends (plus --think-time)
+    open    sessions arrive as a Poisson process at --rate per second,
+            independent of how fast the server answers (--max-open caps them)
+
+Clients can drop a fraction of streams mid-generation (--disconnect-prob)
+and optionally reconnect (--reconnect), the way browsers and proxies do.
+
+Reported: latency percentiles (headers, first event, complete), error
+rates, peak open streams, server memory per open stream (--server-pid,
+Linux only), the server's event-loop lag (--admin-token, when the app runs
+with DIAGNOSTICS_ENABLED) and the generator's own event-loop lag, which must
+stay low for the other numbers to be trustworthy.
+
+Example against the local fake LLM (see benchmarks/fake_llm.py):
+    python -m benchmarks.loadgen --flow htmx --model closed --concurrency 2000 \\
+        --duration 60 --server-pid $(pgrep -f "uvicorn main:app")
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import resource
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from urllib.parse import urlencode, urlsplit
+import stats
+
+PROFILE = {
+    "name": "Nur Aisyah binti Ahmad",
+    "gender": "female",
+    "form": "Form 4",
+    "school": "SMK Taman Connaught",
+    "preferred_language": "Malay",
+    "favourite_subjects": ["Biology", "Chemistry"],
+    "study_frequency": "daily",
+}
+STREAM_URL_RE = re.compile(r'sse-connect="([^"]+)"')
+
+
+# ----------------------
+# Minimal HTTP/1.1 client
+# ----------------------
+# A hand-rolled client keeps per-connection overhead small enough to hold
+# thousands of streams from one process, and avoids extra dependencies.
+class HttpError(Exception):
+    pass
+
+
+async def _open(host: str, port: int, request: bytes):
+    reader, writer = await asyncio.open_connection(host, port, limit=1 << 20)
+    writer.write(request)
+    await writer.drain()
+
+    status_line = await reader.readline()
+    if not status_line:
+        writer.close()
+        raise HttpError("connection closed before response")
+    status = int(status_line.split()[1])
+
+    headers: Dict[str, str] = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+    return reader, writer, status, headers
+
+
+async def _iter_body(reader: asyncio.StreamReader, headers: Dict[str, str]):
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size_line = await reader.readline()
+            if not size_line:
+                return
+            size = int(size_line.split(b";")[0], 16)
+            if size == 0:
+                await reader.readline()
+                return
+            data = await reader.readexactly(size)
+            await reader.readline()
+            yield data
+    elif "content-length" in headers:
+        yield await reader.readexactly(int(headers["content-length"]))
+    else:
+        while data := await reader.read(65536):
+            yield data
+
+
+def _request(method: str, host: str, path: str, body: bytes = b"", content_type: str = "",
+             extra_headers: Optional[Dict[str, str]] = None) -> bytes:
+    lines = [f"{method} {path} HTTP/1.1", f"Host: {host}", "Accept: text/event-stream", "Connection: close"]
+    lines += [f"{key}: {value}" for key, value in (extra_headers or {}).items()]
+    if body:
+        lines += [f"Content-Type: {content_type}", f"Content-Length: {len(body)}"]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+
+async def _iter_sse(reader, headers):
+    """Yield (event, data) pairs from an SSE body."""
+    buffer = b""
+    async for data in _iter_body(reader, headers):
+        buffer += data
+        while b"\n\n" in buffer:
+            frame, buffer = buffer.split(b"\n\n", 1)
+            event, lines = "message", []
+            for line in frame.split(b"\n"):
+                if line.startswith(b"event:"):
+                    event = line[6:].strip().decode()
+                elif line.startswith(b"data:"):
+                    lines.append(line[5:].lstrip())
+                # Comment lines (":") are keepalives and are ignored
+            if lines or event != "message":
+                yield event, b"\n".join(lines)
+
+
+# ----------------------
+# Metrics
+# ----------------------
+@dataclass
+class Stats:
+    started: int = 0
+    completed: int = 0
+    disconnected: int = 0
+    reconnected: int = 0
+    errors: Dict[str, int] = field(default_factory=dict)
+    headers_latency: List[float] = field(default_factory=list)
+    first_event_latency: List[float] = field(default_factory=list)
+    complete_latency: List[float] = field(default_factory=list)
+    open_streams: int = 0
+    peak_open_streams: int = 0
+    loop_lag: List[float] = field(default_factory=list)
+    rss_samples: List[tuple] = field(default_factory=list)
+
+    def error(self, kind: str) -> None:
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def opened(self) -> None:
+        self.open_streams += 1
+        self.peak_open_streams = max(self.peak_open_streams, self.open_streams)
+
+    def closed(self) -> None:
+        self.open_streams -= 1
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    return stats.percentiles(values, (0.50, 0.90, 0.99), digits=None)
+
+
+def read_rss_bytes(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+# ----------------------
+# Sessions
+# ----------------------
+class LoadGenerator:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        target = urlsplit(args.url)
+        self.host = target.hostname or "127.0.0.1"
+        self.port = target.port or 80
+        self.host_header = target.netloc
+        self.stats = Stats()
+        self.deadline = 0.0
+
+    async def _stream(self, request: bytes, t0: float, disconnect_after: Optional[float]) -> str:
+        """Consume one SSE stream; returns 'done', 'error' or 'disconnected'."""
+        reader, writer, status, headers = await _open(self.host, self.port, request)
+        self.stats.headers_latency.append(time.perf_counter() - t0)
+        self.stats.opened()
+        try:
+            if status != 200:
+                self.stats.error(f"http_{status}")
+                return "error"
+
+            first = True
+            async with asyncio.timeout(disconnect_after):
+                async for event, data in _iter_sse(reader, headers):
+                    if first:
+                        self.stats.first_event_latency.append(time.perf_counter() - t0)
+                        first = False
+                    if event == "done" or data.startswith(b'{"type":"done"'):
+                        return "done"
+                    if event == "error" or data.startswith(b'{"type":"error"'):
+                        self.stats.error("error_event")
+                        return "error"
+            self.stats.error("closed_without_done")
+            return "error"
+        except TimeoutError:
+            return "disconnected"
+        finally:
+            self.stats.closed()
+            writer.close()
+
+    async def _setup_htmx(self) -> str:
+        query = urlencode(PROFILE, doseq=True)
+        request = _request("GET", self.host_header, f"/persona/htmx-setup?{query}")
+        reader, writer, status, headers = await _open(self.host, self.port, request)
+        try:
+            body = b"".join([chunk async for chunk in _iter_body(reader, headers)])
+        finally:
+            writer.close()
+        match = STREAM_URL_RE.search(body.decode("utf-8", "replace"))
+        if status != 200 or not match:
+            raise HttpError(f"htmx-setup failed with status {status}")
+        return match.group(1)
+
+    async def session(self) -> None:
+        args = self.args
+        self.stats.started += 1
+        t0 = time.perf_counter()
+        try:
+            if args.flow == "htmx":
+                stream_url = await self._setup_htmx()
+                request = _request("GET", self.host_header, stream_url)
+            else:
+                body = urlencode(PROFILE, doseq=True).encode()
+                request = _request(
+                    "POST", self.host_header, "/persona/stream/",
+                    body, "application/x-www-form-urlencoded"
+                )
+
+            disconnect_after = None
+            if random.random() < args.disconnect_prob:
+                disconnect_after = random.uniform(0, args.disconnect_after)
+
+            outcome = await self._stream(request, t0, disconnect_after)
+            if outcome == "disconnected":
+                self.stats.disconnected += 1
+                if args.reconnect:
+                    # The browser's EventSource retries with the same URL
+                    self.stats.reconnected += 1
+                    await asyncio.sleep(args.reconnect_delay)
+                    t0 = time.perf_counter()
+                    outcome = await self._stream(request, t0, None)
+                else:
+                    return
+
+            if outcome == "done":
+                self.stats.completed += 1
+                self.stats.complete_latency.append(time.perf_counter() - t0)
+        except (OSError, HttpError, asyncio.IncompleteReadError, ValueError) as e:
+            self.stats.error(type(e).__name__)
+
+    async def fetch_admin(self, path: str) -> Optional[dict]:
+        """GET an admin JSON endpoint on the app (requires --admin-token)."""
+        request = _request("GET", self.host_header, path, extra_headers={"X-Admin-Token": self.args.admin_token})
+        try:
+            reader, writer, status, headers = await _open(self.host, self.port, request)
+            try:
+                body = b"".join([chunk async for chunk in _iter_body(reader, headers)])
+            finally:
+                writer.close()
+        except (OSError, HttpError):
+            return None
+        return json.loads(body) if status == 200 else None
+
+    # ----------------------
+    # Arrival models
+    # ----------------------
+    async def closed_model(self) -> None:
+        async def user():
+            while time.perf_counter() < self.deadline:
+                await self.session()
+                if self.args.think_time:
+                    await asyncio.sleep(random.expovariate(1 / self.args.think_time))
+
+        await asyncio.gather(*(user() for _ in range(self.args.concurrency)))
+
+    async def open_model(self) -> None:
+        tasks = set()
+        while time.perf_counter() < self.deadline:
+            await asyncio.sleep(random.expovariate(self.args.rate))
+            if self.stats.open_streams >= self.args.max_open:
+                self.stats.error("dropped_arrival")
+                continue
+            task = asyncio.create_task(self.session())
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    # ----------------------
+    # Samplers
+    # ----------------------
+    async def sample_loop_lag(self, interval: float = 0.05) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.stats.loop_lag.append(time.perf_counter() - start - interval)
+
+    async def sample_rss(self, interval: float = 0.5) -> None:
+        while True:
+            rss = read_rss_bytes(self.args.server_pid)
+            if rss is not None:
+                self.stats.rss_samples.append((self.stats.open_streams, rss))
+            await asyncio.sleep(interval)
+
+    async def run(self) -> dict:
+        baseline_rss = read_rss_bytes(self.args.server_pid) if self.args.server_pid else None
+        samplers = [asyncio.create_task(self.sample_loop_lag())]
+        if baseline_rss is not None:
+            samplers.append(asyncio.create_task(self.sample_rss()))
+
+        started = time.perf_counter()
+        self.deadline = started + self.args.duration
+        if self.args.model == "closed":
+            await self.closed_model()
+        else:
+            await self.open_model()
+        elapsed = time.perf_counter() - started
+
+        for sampler in samplers:
+            sampler.cancel()
+
+        server_lag = None
+        if self.args.admin_token:
+            # Populated when the app runs with DIAGNOSTICS_ENABLED
+            server_lag = await self.fetch_admin("/admin/diagnostics/lag")
+        return self.report(elapsed, baseline_rss, server_lag)
+
+    def report(self, elapsed: float, baseline_rss: Optional[int], server_lag: Optional[dict] = None) -> dict:
+        s = self.stats
+        finished = s.completed + sum(s.errors.values())
+        result = {
+            "flow": self.args.flow,
+            "model": self.args.model,
+            "elapsed_s": round(elapsed, 2),
+            "sessions_started": s.started,
+            "completed": s.completed,
+            "throughput_per_s": round(s.completed / elapsed, 2) if elapsed else 0,
+            "disconnected": s.disconnected,
+            "reconnected": s.reconnected,
+            "errors": s.errors,
+            "error_rate": round(sum(s.errors.values()) / finished, 4) if finished else 0,
+            "peak_open_streams": s.peak_open_streams,
+            "latency_s": {
+                "headers": percentiles(s.headers_latency),
+                "first_event": percentiles(s.first_event_latency),
+                "complete": percentiles(s.complete_latency),
+            },
+            "client_loop_lag_s": percentiles(s.loop_lag),
+        }
+        if server_lag:
+            result["server_loop_lag_s"] = server_lag["lag_s"]
+            result["server_stalls"] = len(server_lag["stalls"])
+        if baseline_rss is not None and s.rss_samples:
+            open_streams, peak_rss = max(s.rss_samples, key=lambda sample: sample[1])
+            result["server_rss"] = {
+                "baseline_bytes": baseline_rss,
+                "peak_bytes": peak_rss,
+                "open_streams_at_peak": open_streams,
+                "bytes_per_open_stream": (
+                    (peak_rss - baseline_rss) // open_streams if open_streams else None
+                ),
+            }
+        return result
+
+
+def _raise_fd_limit() -> None:
+    # Each open stream needs a socket; default soft limits (often 1024) are too low
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Base URL of the app")
+    parser.add_argument("--flow", choices=["stream", "htmx"], default="htmx")
+    parser.add_argument("--model", choices=["closed", "open"], default="closed")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to keep starting sessions")
+    parser.add_argument("--concurrency", type=int, default=100, help="Virtual users (closed model)")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Mean pause between sessions (closed model)")
+    parser.add_argument("--rate", type=float, default=50.0, help="Arrivals per second (open model)")
+    parser.add_argument("--max-open", type=int, default=20000, help="Cap on open streams (open model)")
+    parser.add_argument("--disconnect-prob", type=float, default=0.0, help="Fraction of streams dropped early")
+    parser.add_argument("--disconnect-after", type=float, default=2.0, help="Drop within this many seconds")
+    parser.add_argument("--reconnect", action="store_true", help="Reconnect dropped streams")
+    parser.add_argument("--reconnect-delay", type=float, default=1.0)
+    parser.add_argument("--server-pid", type=int, default=None, help="Sample this process's RSS (Linux)")
+    parser.add_argument("--admin-token", default=None, help="Fetch server loop lag from /admin/diagnostics/lag")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+    _raise_fd_limit()
+    result = asyncio.run(LoadGenerator(args).run())
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Circuit breaker and adaptive timeouts for LLM calls.
+
+Each guarded call gets a timeout derived from recent successful durations
+of the same operation (a high percentile times a multiplier, clamped), so a
+degraded provider is given up on after a few seconds more than a normal
+call takes instead of the client's default timeout.
+
+Outcomes feed a sliding window. When the failure ratio crosses the
+threshold the circuit opens and calls fail immediately with
+CircuitOpenError. After a cool-down one probe call is let through
+(half-open); its outcome closes the circuit or opens it again. While the
+circuit is open, endpoints can serve the last result generated for the
+same profile from a FallbackCache.
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, Optional
+from models import StudentInfo
+from stats import percentile
+from utils import profile_key
+
+STATES = ("closed", "open", "half_open")
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(
+            f"The AI service is temporarily unavailable, please try again in {math.ceil(retry_after)}s."
+        )
+
+
+class LLMTimeoutError(TimeoutError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, window: int, failure_ratio: float, min_calls: int, open_seconds: float,
+                 timeout_percentile: float, timeout_multiplier: float,
+                 min_timeout: float, max_timeout: float, min_samples: int = 20):
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.timeout_percentile = timeout_percentile
+        self.timeout_multiplier = timeout_multiplier
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.min_samples = min_samples
+
+        self.state = "closed"
+        self.changed_at = time.monotonic()
+        self.outcomes: Deque[bool] = deque(maxlen=window)
+        self.durations: Dict[str, Deque[float]] = {}
+        self.counts = {"success": 0, "failure": 0, "timeout": 0, "rejected": 0}
+        self.time_in_state = {state: 0.0 for state in STATES}
+        self.transition_counts: Dict[str, int] = {}
+        self.transitions: Deque[dict] = deque(maxlen=50)
+        self._probing = False
+
+    def timeout(self, operation: str) -> float:
+        """Percentile of recent successful durations times the multiplier, clamped."""
+        samples = self.durations.get(operation)
+        if not samples or len(samples) < self.min_samples:
+            return self.max_timeout
+        observed = percentile(sorted(samples), self.timeout_percentile)
+        return min(self.max_timeout, max(self.min_timeout, observed * self.timeout_multiplier))
+
+    def check(self) -> None:
+        """Raise CircuitOpenError if a call should not be attempted now."""
+        if self.state == "open":
+            remaining = self.open_seconds - (time.monotonic() - self.changed_at)
+            if remaining > 0:
+                self.counts["rejected"] += 1
+                raise CircuitOpenError(remaining)
+            self._transition("half_open", "cool-down elapsed")
+        if self.state == "half_open" and self._probing:
+            # Only one probe at a time while the provider is being tested
+            self.counts["rejected"] += 1
+            raise CircuitOpenError(1.0)
+
+    @asynccontextmanager
+    async def guard(self, operation: str):
+        """Run one LLM call under the breaker with an adaptive timeout."""
+        self.check()
+        probe = self.state == "half_open"
+        if probe:
+            self._probing = True
+        limit = self.timeout(operation)
+        started = time.monotonic()
+        try:
+            try:
+                async with asyncio.timeout(limit):
+                    yield
+            except TimeoutError:
+                self._record(False, "timeout", f"{operation} timed out after {limit:.1f}s")
+                raise LLMTimeoutError(f"The AI service did not respond within {limit:.0f}s.")
+            except Exception as e:
+                self._record(False, "failure", f"{operation} failed: {type(e).__name__}")
+                raise
+            else:
+                self._record(True, "success")
+                self.durations.setdefault(operation, deque(maxlen=200)).append(time.monotonic() - started)
+        finally:
+            # A cancelled call (client went away) says nothing about the provider
+            if probe:
+                self._probing = False
+
+    def _record(self, success: bool, kind: str, reason: str = "") -> None:
+        self.counts[kind] += 1
+        if self.state == "half_open":
+            self._transition("closed" if success else "open", reason or "probe succeeded")
+        elif self.state == "closed":
+            self.outcomes.append(success)
+            failures = self.outcomes.count(False)
+            if len(self.outcomes) >= self.min_calls and failures / len(self.outcomes) >= self.failure_ratio:
+                self._transition("open", f"{failures}/{len(self.outcomes)} calls failed, last: {reason}")
+
+    def _transition(self, state: str, reason: str) -> None:
+        now = time.monotonic()
+        self.time_in_state[self.state] += now - self.changed_at
+        name = f"{self.state}->{state}"
+        self.transition_counts[name] = self.transition_counts.get(name, 0) + 1
+        self.transitions.append({"transition": name, "at": time.time(), "reason": reason})
+        self.state = state
+        self.changed_at = now
+        if state == "closed":
+            self.outcomes.clear()
+
+    def summary(self) -> dict:
+        in_state = time.monotonic() - self.changed_at
+        return {
+            "state": self.state,
+            "in_state_s": round(in_state, 2),
+            "time_in_state_s": {
+                state: round(total + (in_state if state == self.state else 0.0), 2)
+                for state, total in self.time_in_state.items()
+            },
+            "window_failures": self.outcomes.count(False),
+            "window_calls": len(self.outcomes),
+            "counts": dict(self.counts),
+            "transition_counts": dict(self.transition_counts),
+            "transitions": list(self.transitions),
+            "timeouts_s": {
+                operation: {"timeout": round(self.timeout(operation), 2), "samples": len(samples)}
+                for operation, samples in self.durations.items()
+            },
+        }
+
+
+class FallbackCache:
+    """Last successful result per (kind, profile), served while the circuit is open."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Any]" = OrderedDict()
+        self.served = 0
+
+    def put(self, kind: str, student: StudentInfo, value: Any) -> None:
+        key = f"{kind}:{profile_key(student)}"
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, kind: str, student: StudentInfo) -> Optional[Any]:
+        value = self._entries.get(f"{kind}:{profile_key(student)}")
+        if value is not None:
+            self.served += 1
+        return value
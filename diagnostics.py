@@ -0,0 +1,340 @@
+"""
+Opt-in event-loop diagnostics.
+
+- LagMonitor samples event-loop lag continuously. A watchdog thread notices
+  when the loop stops ticking and captures the loop thread's stack plus the
+  handler/stage label of the task that is blocking it.
+- RequestProfiler samples the loop thread while a single request's tasks are
+  running and returns folded stacks ("a;b;c 12"), which flamegraph.pl and
+  speedscope read directly.
+
+Everything is off unless DIAGNOSTICS_ENABLED is set; stage() then returns a
+shared no-op context manager and no middleware or threads are installed.
+"""
+import asyncio
+import contextvars
+import os
+import secrets
+import sys
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+from stats import percentile
+
+# ----------------------
+# Stage labels
+# ----------------------
+# Handler label (route path) inherited by every task spawned for the request
+_handler: contextvars.ContextVar[str] = contextvars.ContextVar("diagnostics_handler", default="-")
+# Set for tasks that belong to a request being profiled
+_profile_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("diagnostics_profile_id", default=None)
+# Innermost stage; a context variable so that tasks LangChain spawns per
+# runnable step inherit it. The watchdog reads it from the blocking task.
+_stage: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("diagnostics_stage", default=None)
+
+_enabled = False
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ("name", "token")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.token = _stage.set(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        _stage.reset(self.token)
+        return False
+
+
+def stage(name: str):
+    """Label the code in this block for stall reports (no-op when disabled)."""
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+# ----------------------
+# Task contexts
+# ----------------------
+# The threads below read the labels from the context of the task running on
+# the loop. Task.get_context() only exists from Python 3.12, so on older
+# versions a task factory records each task's context as it is created.
+_task_contexts: "weakref.WeakKeyDictionary[asyncio.Task, contextvars.Context]" = weakref.WeakKeyDictionary()
+
+
+def _recording_task_factory(loop, coro, context=None):
+    if context is None:
+        context = contextvars.copy_context()
+    task = asyncio.Task(coro, loop=loop, context=context)
+    _task_contexts[task] = context
+    return task
+
+
+def _install_task_factory(loop: asyncio.AbstractEventLoop) -> None:
+    # Not needed where tasks expose their context, or when another factory is installed
+    if hasattr(asyncio.Task, "get_context") or loop.get_task_factory() is not None:
+        return
+    loop.set_task_factory(_recording_task_factory)
+
+
+def _task_context(task: Optional[asyncio.Task]) -> Optional[contextvars.Context]:
+    if task is None:
+        return None
+    if hasattr(task, "get_context"):
+        return task.get_context()
+    return _task_contexts.get(task)
+
+
+def _task_label(task: Optional[asyncio.Task]) -> str:
+    if task is None:
+        return "no task"
+    context = _task_context(task)
+    if context is None:
+        return "unlabelled"
+    return f"{context.get(_handler, '-')} [{context.get(_stage) or 'unlabelled'}]"
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _stack(frame) -> List[str]:
+    """Frames from outermost to innermost."""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+# ----------------------
+# Event-loop lag monitor
+# ----------------------
+class LagMonitor:
+    def __init__(self, interval: float, stall_threshold: float, history: int = 600):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.samples: deque = deque(maxlen=history)
+        self.stalls: deque = deque(maxlen=100)
+        self.max_lag = 0.0
+        self._tick = time.monotonic()
+        self._pending_stall: Optional[dict] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        _install_task_factory(self._loop)
+        self._tick = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._sample())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _sample(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(time.perf_counter() - start - self.interval, 0.0)
+            self._tick = time.monotonic()
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+            if lag >= self.stall_threshold:
+                stall = self._pending_stall or {"label": "unlabelled", "stack": []}
+                stall.update({"at": time.time(), "lag_s": round(lag, 4)})
+                self.stalls.append(stall)
+            self._pending_stall = None
+
+    def _watch(self) -> None:
+        # Runs in a thread: sees the loop thread while it is blocked
+        while not self._stop.wait(self.interval / 2):
+            blocked_for = time.monotonic() - self._tick - self.interval
+            if blocked_for < self.stall_threshold or self._pending_stall is not None:
+                continue
+
+            try:
+                frame = sys._current_frames().get(self._loop_thread_id)
+                task = asyncio.current_task(self._loop)
+                self._pending_stall = {
+                    "label": _task_label(task),
+                    "stack": _stack(frame)[-15:] if frame else [],
+                }
+            except Exception as e:
+                # Never let one bad sample end the watchdog
+                self._pending_stall = {"label": f"watchdog error: {e!r}", "stack": []}
+
+    def summary(self) -> dict:
+        ordered = sorted(self.samples)
+
+        def pick(q: float) -> float:
+            return round(percentile(ordered, q), 4)
+        return {
+            "interval_s": self.interval,
+            "stall_threshold_s": self.stall_threshold,
+            "samples": len(ordered),
+            "lag_s": {"p50": pick(0.50), "p90": pick(0.90), "p99": pick(0.99), "max": round(self.max_lag, 4)},
+            "stalls": list(self.stalls),
+        }
+
+
+# ----------------------
+# On-demand request profiler
+# ----------------------
+class RequestProfiler:
+    """Samples the loop thread while tasks belonging to one request are running."""
+
+    def __init__(self, profile_id: str, loop: asyncio.AbstractEventLoop, interval: float):
+        self.profile_id = profile_id
+        self.interval = interval
+        self.counts: Dict[str, int] = {}
+        self._loop = loop
+        self._loop_thread_id = threading.get_ident()
+        _install_task_factory(loop)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"profiler-{profile_id}", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> str:
+        self._stop.set()
+        self._thread.join()
+        return self.folded()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                context = _task_context(asyncio.current_task(self._loop))
+                if context is None or context.get(_profile_id) != self.profile_id:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is None:
+                    continue
+                key = ";".join(_stack(frame))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            except Exception:
+                # A sample lost, not the profile
+                continue
+
+    def folded(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.counts.items())
+
+
+# ----------------------
+# ASGI middleware
+# ----------------------
+class DiagnosticsMiddleware:
+    """
+    Labels each request's tasks with its route path and, when the request
+    carries `X-Profile: <admin token>`, profiles it until the response body
+    is complete. The profile id is returned in the `X-Profile-Id` header.
+    """
+
+    def __init__(self, app, profile_token: Optional[str], profile_interval: float,
+                 store: "OrderedDict[str, str]", max_profiles: int = 20):
+        self.app = app
+        self.profile_token = profile_token
+        self.profile_interval = profile_interval
+        self.store = store
+        self.max_profiles = max_profiles
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        _handler.set(scope["path"])
+        headers = dict(scope.get("headers") or [])
+        token = headers.get(b"x-profile")
+        if not self.profile_token or token is None or not secrets.compare_digest(token, self.profile_token.encode()):
+            return await self.app(scope, receive, send)
+
+        profile_id = uuid.uuid4().hex[:12]
+        _profile_id.set(profile_id)
+        profiler = RequestProfiler(profile_id, asyncio.get_running_loop(), self.profile_interval)
+        profiler.start()
+        finished = False
+
+        def finish() -> None:
+            nonlocal finished
+            if not finished:
+                finished = True
+                self.store[profile_id] = profiler.stop()
+                while len(self.store) > self.max_profiles:
+                    self.store.popitem(last=False)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-profile-id", profile_id.encode())
+                ]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finish()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            finish()
+
+
+# ----------------------
+# Wiring
+# ----------------------
+lag_monitor: Optional[LagMonitor] = None
+profiles: "OrderedDict[str, str]" = OrderedDict()
+
+
+def setup(app, enabled: bool, lag_interval: float, stall_threshold: float,
+          profile_token: Optional[str], profile_interval: float) -> None:
+    """Install the middleware if diagnostics are enabled (call before startup)."""
+    global _enabled, lag_monitor
+    _enabled = enabled
+    if not enabled:
+        return
+    lag_monitor = LagMonitor(lag_interval, stall_threshold)
+    app.add_middleware(
+        DiagnosticsMiddleware,
+        profile_token=profile_token,
+        profile_interval=profile_interval,
+        store=profiles,
+    )
+
+
+def is_enabled() -> bool:
+    return _enabled
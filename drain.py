@@ -0,0 +1,137 @@
+"""
+Connection draining for graceful shutdown.
+
+On SIGTERM (or the lifespan shutdown, or POST /admin/drain) the app stops
+accepting new generations: they are refused with a Retry-After hint so the
+client retries against another instance. Streams already running are left
+to finish for up to the grace period; whatever is still running then is cut
+off with a final retry event. Lifespan shutdown waits for the streams and
+then flushes pending trace and recording writes.
+
+The SIGTERM handler chains to the server's own, so uvicorn still closes its
+listening sockets at once and waits for open connections, which is when the
+in-flight streams finish.
+"""
+import asyncio
+import logging
+import signal
+import time
+from typing import Optional, Set
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class DrainingError(Exception):
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__("The server is restarting, please try again in a few seconds.")
+
+
+class Drainer:
+    def __init__(self, grace_seconds: float, retry_after: float):
+        self.grace_seconds = grace_seconds
+        self.retry_after = retry_after
+        self.draining = False
+        self.streams: Set[asyncio.Task] = set()
+        # completed: finished before any drain; drained: finished during one;
+        # aborted: cut off at the end of the grace period; cancelled: client left
+        self.stats = {"completed": 0, "drained": 0, "aborted": 0, "cancelled": 0, "rejected": 0}
+        self.drain_info: Optional[dict] = None
+        self._aborting: Set[asyncio.Task] = set()
+        self._idle = asyncio.Event()
+        self._grace_timer: Optional[asyncio.TimerHandle] = None
+
+    def install_signal_handler(self, sig: int = signal.SIGTERM) -> None:
+        """Start draining on `sig`, then hand the signal to the server's handler."""
+        loop = asyncio.get_running_loop()
+        previous = signal.getsignal(sig)
+        if not callable(previous):
+            # Not running under a server that handles the signal; lifespan shutdown drains
+            return
+
+        def handler(signum, frame):
+            loop.call_soon_threadsafe(self.start, signal.Signals(signum).name)
+            previous(signum, frame)
+
+        try:
+            signal.signal(sig, handler)
+        except ValueError:
+            # Signals can only be handled from the main thread
+            pass
+
+    def check(self) -> None:
+        """Raise DrainingError if new generations are no longer accepted."""
+        if self.draining:
+            self.stats["rejected"] += 1
+            raise DrainingError(self.retry_after)
+
+    def start(self, reason: str) -> None:
+        if self.draining:
+            return
+        self.draining = True
+        self.drain_info = {
+            "reason": reason,
+            "started_at": time.time(),
+            "in_flight": len(self.streams),
+            "grace_seconds": self.grace_seconds,
+        }
+        logger.info("Draining %d stream(s) (%s), grace period %.0fs",
+                    len(self.streams), reason, self.grace_seconds)
+        if not self.streams:
+            self._idle.set()
+        self._grace_timer = asyncio.get_running_loop().call_later(self.grace_seconds, self._abort_all)
+
+    def _abort_all(self) -> None:
+        for task in self.streams:
+            self._aborting.add(task)
+            task.cancel()
+
+    async def guard(self, frames, abort_frame: bytes):
+        """Pass a stream's frames through; cut it off with `abort_frame` when the grace period ends."""
+        task = asyncio.current_task()
+        self.streams.add(task)
+        outcome = "cancelled"
+        try:
+            try:
+                async for frame in frames:
+                    yield frame
+                outcome = "drained" if self.draining else "completed"
+            except asyncio.CancelledError:
+                if task not in self._aborting:
+                    raise
+                # Our own cancellation: the stream below has been closed, tell the client to retry
+                task.uncancel()
+                outcome = "aborted"
+                yield abort_frame
+        finally:
+            if task in self._aborting:
+                # Cancelled outside our frames (while sending): still cut off by the drain
+                outcome = "aborted"
+                self._aborting.discard(task)
+            self.streams.discard(task)
+            self.stats[outcome] += 1
+            if self.draining and not self.streams:
+                self._idle.set()
+
+    async def wait(self) -> None:
+        """Drain (if not already draining) and wait until no stream is left."""
+        self.start("shutdown")
+        try:
+            # Aborted streams only need to send their last frame
+            await asyncio.wait_for(self._idle.wait(), self.grace_seconds + 5)
+        except asyncio.TimeoutError:
+            pass
+        if self._grace_timer is not None:
+            self._grace_timer.cancel()
+        self.drain_info["duration_s"] = round(time.time() - self.drain_info["started_at"], 3)
+        logger.info("Drain finished in %.1fs: %d drained, %d aborted, %d rejected",
+                    self.drain_info["duration_s"], self.stats["drained"], self.stats["aborted"],
+                    self.stats["rejected"])
+
+    def summary(self) -> dict:
+        return {
+            "draining": self.draining,
+            "in_flight": len(self.streams),
+            **self.stats,
+            "drain": self.drain_info,
+        }
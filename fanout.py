@@ -0,0 +1,79 @@
+"""
+Fan-out persona generation.
+
+Instead of one long completion for the whole PersonaAnalysis, the persona
+paragraph and each learning method are requested as concurrent small calls
+that share a prompt prefix (and a prompt_cache_key, so the provider can route
+them to the same cache). Sections are yielded as soon as their call
+completes, then merged into a PersonaAnalysis like the single-call path.
+"""
+import asyncio
+from typing import AsyncIterator, Dict, Optional, Tuple, Union
+from langchain_core.prompts import PromptTemplate
+from models import StudentInfo, PersonaAnalysis, PersonaDraft, PersonaParagraph, MethodDraft, LearningMethod
+from utils import (
+    create_fanout_prompt, build_persona_analysis, infer_language_preference,
+    profile_key, LEARNING_METHODS
+)
+
+SECTIONS = ["persona"] + [method["key"] for method in LEARNING_METHODS]
+
+Section = Union[PersonaParagraph, MethodDraft]
+
+
+async def generate_sections(llm, student: StudentInfo, text_summary: str, concurrency: int,
+                            config: Optional[dict] = None) -> AsyncIterator[Tuple[str, Section]]:
+    """Yield (section, result) in completion order. Outstanding calls are cancelled on exit."""
+    semaphore = asyncio.Semaphore(concurrency)
+    cache_key = profile_key(student)
+
+    async def run(section: str) -> Tuple[str, Section]:
+        schema = PersonaParagraph if section == "persona" else MethodDraft
+        chain = (
+            PromptTemplate.from_template("{prompt_str}")
+            | llm.with_structured_output(schema, prompt_cache_key=cache_key)
+        )
+        async with semaphore:
+            result = await chain.ainvoke(
+                {"prompt_str": create_fanout_prompt(text_summary, section)},
+                config=config
+            )
+        return section, result
+
+    tasks = [asyncio.create_task(run(section)) for section in SECTIONS]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def merge_sections(student: StudentInfo, sections: Dict[str, Section]) -> PersonaAnalysis:
+    """Combine completed sections into a full, validated PersonaAnalysis."""
+    draft = PersonaDraft(
+        student_persona=sections["persona"].student_persona,
+        **{key: sections[key] for key in SECTIONS if key != "persona"}
+    )
+    return build_persona_analysis(student, draft)
+
+
+def render_section_card(templates, student: StudentInfo, section: str, result: Section) -> str:
+    """Card HTML for one completed section, marked to replace its placeholder (hx-swap-oob)."""
+    if section == "persona":
+        analysis = {
+            "language_preference": infer_language_preference(student),
+            "student_persona": result.student_persona,
+        }
+        html = templates.get_template("_persona_card.html").render(analysis=analysis, oob=True)
+    else:
+        index = SECTIONS.index(section) - 1
+        method = LEARNING_METHODS[index]
+        card = LearningMethod(
+            method_name=method["method_name"],
+            icon=method["icon"],
+            rationale=result.rationale,
+            example=result.example
+        )
+        html = templates.get_template("_method_card.html").render(method=card, index=index, oob=True)
+    return html.replace('\n', ' ')
@@ -0,0 +1,34 @@
+"""
+Hybrid structured persona generation.
+
+The model is only asked for a PersonaDraft (persona paragraph plus a
+rationale and example per method). The method names, icons and language
+preference are derived locally and merged back into a full PersonaAnalysis,
+so far fewer output tokens are generated per request.
+"""
+from typing import Optional
+from langchain_core.prompts import PromptTemplate
+from models import StudentInfo, PersonaAnalysis, PersonaDraft
+from utils import student_text, create_persona_draft_prompt, build_persona_analysis
+
+
+def persona_draft_chain(llm):
+    return (
+        PromptTemplate.from_template("{prompt_str}")
+        | llm.with_structured_output(PersonaDraft)
+    )
+
+
+async def generate_persona_analysis(llm, student: StudentInfo, config: Optional[dict] = None,
+                                    text_summary: Optional[str] = None, chain=None) -> PersonaAnalysis:
+    """chain: a persona_draft_chain to use instead of building one (e.g. to watch it for leaks)"""
+    if text_summary is None:
+        text_summary = student_text(student)
+    if chain is None:
+        chain = persona_draft_chain(llm)
+
+    draft = await chain.ainvoke(
+        {"prompt_str": create_persona_draft_prompt(text_summary)},
+        config=config
+    )
+    return build_persona_analysis(student, draft)
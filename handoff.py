@@ -0,0 +1,56 @@
+import secrets
+import time
+from collections import OrderedDict
+from typing import Optional
+from models import StudentInfo
+
+
+class HandoffStore:
+    """
+    Short-lived server-side store for validated student profiles.
+
+    The setup request validates the form once and stores the resulting
+    StudentInfo under an opaque ticket; the SSE connection only carries the
+    ticket, so the profile stays out of URLs and logs. Entries stay readable
+    until they expire so that EventSource reconnects can reuse the same
+    ticket.
+
+    Entries live in this process only: the stream (and its reconnects) must
+    reach the worker that served the setup request.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple[float, StudentInfo]]" = OrderedDict()
+
+    def put(self, student: StudentInfo) -> str:
+        now = time.monotonic()
+        self._evict(now)
+
+        ticket = secrets.token_urlsafe(16)
+        self._entries[ticket] = (now + self.ttl_seconds, student)
+        return ticket
+
+    def get(self, ticket: str) -> Optional[StudentInfo]:
+        entry = self._entries.get(ticket)
+        if entry is None:
+            return None
+
+        expires_at, student = entry
+        if expires_at <= time.monotonic():
+            del self._entries[ticket]
+            return None
+        return student
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _evict(self, now: float) -> None:
+        # Entries are kept in insertion order and share one TTL, so expired
+        # ones are always at the front
+        while self._entries:
+            ticket, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) < self.max_entries:
+                break
+            del self._entries[ticket]
@@ -0,0 +1,166 @@
+"""
+Shared SSE heartbeats for idle streams.
+
+A stream can go quiet for a long time (the structured persona call returns
+all at once), and proxies drop connections that send nothing, after which
+the client reconnects and generation starts over. Every stream served by
+HeartbeatResponse is registered with one HeartbeatScheduler: a single task
+turning a timer wheel, which sends an SSE comment to each stream that has
+sent nothing for a whole interval. There is no task or timer per connection.
+
+Sending a frame only stores a timestamp. A stream is placed in the wheel slot
+where its heartbeat is due. When the slot comes up, a stream that sent
+something in the meantime is moved to its new due slot instead. Each stream
+is therefore looked at about once per interval, however many frames it sends.
+"""
+import asyncio
+import math
+import time
+from typing import List, Optional, Set
+from starlette.responses import StreamingResponse
+from serialization import SSE_HEARTBEAT
+
+
+class _Stream:
+    __slots__ = ("send", "frame", "last_sent", "sending", "started", "finished")
+
+    def __init__(self, send, frame: bytes):
+        self.send = send
+        self.frame = frame
+        self.last_sent = time.monotonic()
+        self.sending = 0
+        self.started = False
+        self.finished = False
+
+    async def tracked_send(self, message) -> None:
+        # Wraps the response's ASGI send to see when it is busy, idle or done
+        if message["type"] == "http.response.start":
+            self.started = True
+        elif not message.get("more_body", False):
+            self.finished = True
+        self.sending += 1
+        try:
+            await self.send(message)
+        finally:
+            self.sending -= 1
+            self.last_sent = time.monotonic()
+
+
+class HeartbeatScheduler:
+    def __init__(self, interval: float, resolution: int = 8):
+        """
+        interval: seconds of silence before a stream gets a heartbeat
+        resolution: wheel ticks per interval (heartbeats are at most interval/resolution late)
+        """
+        self.interval = interval
+        self.tick = interval / resolution
+        # One slot per tick plus one, so any due time within an interval has a slot
+        self.slots: List[Set[_Stream]] = [set() for _ in range(resolution + 1)]
+        self.position = 0
+        self.started_at = time.monotonic()
+        self.streams = 0
+        self.stats = {"heartbeats": 0, "skipped": 0, "rescheduled": 0, "ticks": 0}
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, send, frame: bytes = SSE_HEARTBEAT) -> _Stream:
+        if self._task is None:
+            # The wheel's clock starts with its first stream; any entries left are finished streams
+            self.started_at = time.monotonic()
+            self.position = 0
+            self.slots = [set() for _ in self.slots]
+            self._task = asyncio.create_task(self._run())
+        stream = _Stream(send, frame)
+        self._schedule(stream, stream.last_sent + self.interval)
+        self.streams += 1
+        return stream
+
+    def unregister(self, stream: _Stream) -> None:
+        # Its slot entry is dropped lazily when the slot comes up
+        stream.finished = True
+        self.streams -= 1
+
+    def _schedule(self, stream: _Stream, due: float) -> None:
+        # Ticks from the wheel's current position until `due`, at least the next one
+        current = self.started_at + self.position * self.tick
+        ahead = min(max(math.ceil((due - current) / self.tick), 1), len(self.slots) - 1)
+        self.slots[(self.position + ahead) % len(self.slots)].add(stream)
+
+    async def _run(self) -> None:
+        # Runs while there are streams; the next register starts it again
+        while self.streams:
+            # Sleep to the next tick on the wheel's own clock, so ticks do not drift
+            self.position += 1
+            await asyncio.sleep(max(self.started_at + self.position * self.tick - time.monotonic(), 0))
+            self.stats["ticks"] += 1
+            index = self.position % len(self.slots)
+            due, self.slots[index] = self.slots[index], set()
+            now = time.monotonic()
+            for stream in due:
+                if stream.finished:
+                    continue
+                if stream.sending or not stream.started or now - stream.last_sent < self.interval - self.tick / 2:
+                    # Sent something since it was scheduled (or is sending now): move it along
+                    self.stats["rescheduled"] += 1
+                    self._schedule(stream, stream.last_sent + self.interval)
+                    continue
+                self._heartbeat(stream)
+                self._schedule(stream, time.monotonic() + self.interval)
+        self._task = None
+
+    def _heartbeat(self, stream: _Stream) -> None:
+        """
+        Send one heartbeat only if it goes out without waiting. The send is
+        stepped once by hand: a server send that has to wait (the client is
+        not reading, so its writes are paused) is closed before it writes
+        anything, rather than holding up the wheel or paying for a timeout
+        on every send.
+        """
+        send = stream.tracked_send({"type": "http.response.body", "body": stream.frame, "more_body": True})
+        try:
+            send.send(None)
+        except StopIteration:
+            self.stats["heartbeats"] += 1
+            return
+        except (OSError, RuntimeError):
+            # Already gone; the stream itself will notice
+            pass
+        else:
+            send.close()
+        self.stats["skipped"] += 1
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def summary(self) -> dict:
+        return {
+            "interval_s": self.interval,
+            "streams": self.streams,
+            **self.stats,
+        }
+
+
+class HeartbeatResponse(StreamingResponse):
+    """StreamingResponse whose stream gets heartbeats from `heartbeat` while idle."""
+
+    def __init__(self, content, heartbeat: Optional[HeartbeatScheduler] = None,
+                 heartbeat_frame: Optional[bytes] = SSE_HEARTBEAT, **kwargs):
+        """heartbeat_frame: sent on idle; None turns heartbeats off (formats with no comment syntax)"""
+        super().__init__(content, **kwargs)
+        self.heartbeat = heartbeat
+        self.heartbeat_frame = heartbeat_frame
+
+    async def __call__(self, scope, receive, send) -> None:
+        if self.heartbeat is None or self.heartbeat_frame is None:
+            await super().__call__(scope, receive, send)
+            return
+        stream = self.heartbeat.register(send, self.heartbeat_frame)
+        try:
+            await super().__call__(scope, receive, stream.tracked_send)
+        finally:
+            self.heartbeat.unregister(stream)
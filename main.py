@@ -1,23 +1,90 @@
-from fastapi import FastAPI, Request, Form, Query
+from fastapi import FastAPI, Request, Form, Query, Header, HTTPException, Depends
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, PlainTextResponse, Response
 from langchain_core.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
 from langfuse import get_client
 from langfuse.langchain import CallbackHandler as LangfuseCallbackHandler
 from dotenv import load_dotenv
 import os
 import asyncio
-import json
+import logging
+import secrets
+from contextlib import aclosing, asynccontextmanager, nullcontext
 from datetime import datetime
 from typing import List, Optional
 from langchain_core.callbacks import AsyncCallbackHandler
-from models import StudentInfo, PersonaAnalysis
-from utils import student_text, create_persona_prompt, SUBJECTS_LIST
+from pydantic import ValidationError
+from models import StudentInfo
+from utils import (
+    student_text, create_persona_prompt, canonical_student, profile_key,
+    SUBJECTS_LIST, LEARNING_METHODS
+)
+from handoff import HandoffStore
+from pipeline import (
+    Pipeline, PipelineContext, PipelineError, StageTimings, Event, ENCODERS, HtmxSseEncoder, JsonEncoder,
+    PROCESSING, THINKING, STREAMING, GENERATING
+)
+import diagnostics
+from memory import stream_registry, snapshot_store
+from batch import ClassPersonaGenerator, PackSizer
+from generation import generate_persona_analysis, persona_draft_chain
+from fanout import generate_sections, merge_sections, render_section_card
+from speculation import SpeculationCache
+from scheduling import FairScheduler, tenant_of
+from backends import create_llm, flush_recordings
+from breaker import CircuitBreaker, CircuitOpenError, FallbackCache
+from usage import Pricing, UsageCounter, UsageLedger
+from drain import Drainer, DrainingError
+from heartbeat import HeartbeatScheduler, HeartbeatResponse
+from settings import (
+    HANDOFF_TTL_SECONDS, HANDOFF_MAX_ENTRIES, ADMIN_TOKEN,
+    DIAGNOSTICS_ENABLED, DIAGNOSTICS_LAG_INTERVAL, DIAGNOSTICS_STALL_THRESHOLD,
+    DIAGNOSTICS_PROFILE_INTERVAL, BATCH_MAX_OUTPUT_TOKENS, BATCH_MAX_PACK_SIZE,
+    BATCH_INITIAL_TOKENS_PER_STUDENT, BATCH_CONCURRENCY, PERSONA_GENERATION_MODE,
+    FANOUT_CONCURRENCY, SPECULATION_ENABLED, SPECULATION_TTL_SECONDS, SPECULATION_MAX_ENTRIES,
+    SCHEDULER_ENABLED, SCHEDULER_CAPACITY, SCHEDULER_TENANT_KEY, SCHEDULER_TENANT_RATE,
+    SCHEDULER_TENANT_BURST, SCHEDULER_TENANT_WEIGHTS, SCHEDULER_TENANT_IDLE_SECONDS,
+    LLM_BACKEND, LLM_RECORD_PATH, LLM_REPLAY_TIME_SCALE, LLM_REPLAY_STRICT,
+    BREAKER_ENABLED, BREAKER_WINDOW,
+    BREAKER_FAILURE_RATIO, BREAKER_MIN_CALLS, BREAKER_OPEN_SECONDS, BREAKER_TIMEOUT_PERCENTILE,
+    BREAKER_TIMEOUT_MULTIPLIER, BREAKER_MIN_TIMEOUT, BREAKER_MAX_TIMEOUT, BREAKER_FALLBACK_ENTRIES,
+    USAGE_PRICES, USAGE_TOP_REQUESTS, USAGE_MAX_TENANTS,
+    DRAIN_GRACE_SECONDS, DRAIN_RETRY_AFTER_SECONDS, HEARTBEAT_INTERVAL_SECONDS
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if diagnostics.lag_monitor:
+        diagnostics.lag_monitor.start()
+    drainer.install_signal_handler()
+    yield
+    # Let in-flight streams finish (or cut them off), then flush what they left behind
+    await drainer.wait()
+    get_client().flush()
+    await flush_recordings()
+    if heartbeat:
+        await heartbeat.stop()
+    if diagnostics.lag_monitor:
+        await diagnostics.lag_monitor.stop()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
+diagnostics.setup(
+    app,
+    enabled=DIAGNOSTICS_ENABLED,
+    lag_interval=DIAGNOSTICS_LAG_INTERVAL,
+    stall_threshold=DIAGNOSTICS_STALL_THRESHOLD,
+    profile_token=ADMIN_TOKEN,
+    profile_interval=DIAGNOSTICS_PROFILE_INTERVAL
+)
 templates = Jinja2Templates(directory="templates")
 
+# Fan-out mode sends the card placeholders first; they never change
+FANOUT_SKELETON_HTML = (
+    templates.get_template("_dashboard_skeleton.html").render(methods=LEARNING_METHODS).replace('\n', ' ')
+)
+
 # ----------------------
 # Load environment variables
 # ----------------------
@@ -26,12 +93,156 @@ load_dotenv()
 # ----------------------
 # LLM setup
 # ----------------------
-llm = ChatOpenAI(
+# LLM_BACKEND picks the live client, a recorder or an offline replay (see backends.py)
+llm = create_llm(
+    LLM_BACKEND,
+    record_path=LLM_RECORD_PATH,
+    time_scale=LLM_REPLAY_TIME_SCALE,
+    strict=LLM_REPLAY_STRICT,
     openai_api_key=os.getenv("OPENAI_API_KEY"),
     temperature=0.8,
     model_name="gpt-5-nano",
     # gpt-5-nano is the latest model from OpenAI in December 2025, do not attempt to change this
-    streaming=True
+    streaming=True,
+    # Ask for token usage on streamed calls too (off by default with a custom base URL)
+    stream_usage=True
+)
+
+# ----------------------
+# Usage accounting
+# ----------------------
+# Tokens and cost of every streamed request, per endpoint and tenant (see usage.py)
+pricing = Pricing(USAGE_PRICES)
+usage_ledger = UsageLedger(SCHEDULER_TENANT_KEY, top_n=USAGE_TOP_REQUESTS, max_tenants=USAGE_MAX_TENANTS)
+
+# ----------------------
+# Draining
+# ----------------------
+# Refuses new generations and winds down open streams on shutdown (see drain.py)
+drainer = Drainer(DRAIN_GRACE_SECONDS, DRAIN_RETRY_AFTER_SECONDS)
+
+
+def accepting_generations():
+    """Dependency of the endpoints that start generations: 503 with Retry-After while draining"""
+    try:
+        drainer.check()
+    except DrainingError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(round(e.retry_after))})
+
+
+# ----------------------
+# Heartbeats
+# ----------------------
+# One timer wheel sends keepalives to every idle stream, so proxies keep them open
+heartbeat = HeartbeatScheduler(HEARTBEAT_INTERVAL_SECONDS) if HEARTBEAT_INTERVAL_SECONDS > 0 else None
+
+# ----------------------
+# Profile handoff store
+# ----------------------
+# Validated profiles wait here for their SSE connection, keyed by an opaque ticket
+handoff_store = HandoffStore(HANDOFF_TTL_SECONDS, HANDOFF_MAX_ENTRIES)
+if int(os.getenv("WEB_CONCURRENCY") or 1) > 1:
+    # Each worker has its own store; a stream reaching another worker finds no ticket
+    logging.getLogger("uvicorn.error").warning(
+        "WEB_CONCURRENCY=%s: htmx tickets are kept per worker, so /persona/stream-htmx needs "
+        "sticky sessions or a single worker", os.getenv("WEB_CONCURRENCY")
+    )
+
+# ----------------------
+# Generation scheduling
+# ----------------------
+# Shares LLM capacity fairly between tenants (schools) instead of first come, first served
+scheduler = (
+    FairScheduler(
+        SCHEDULER_CAPACITY,
+        rate=SCHEDULER_TENANT_RATE,
+        burst=SCHEDULER_TENANT_BURST,
+        weights=SCHEDULER_TENANT_WEIGHTS,
+        idle_seconds=SCHEDULER_TENANT_IDLE_SECONDS
+    ) if SCHEDULER_ENABLED else None
+)
+
+
+def generation_slot(student: StudentInfo, priority: str):
+    """Scheduler slot held around one generation; a no-op when scheduling is disabled"""
+    if scheduler is None:
+        return nullcontext()
+    return scheduler.slot(tenant_of(student, SCHEDULER_TENANT_KEY), priority)
+
+
+# ----------------------
+# Circuit breaker
+# ----------------------
+# Adaptive timeouts and fail-fast for the streaming endpoints' LLM calls
+breaker = (
+    CircuitBreaker(
+        window=BREAKER_WINDOW,
+        failure_ratio=BREAKER_FAILURE_RATIO,
+        min_calls=BREAKER_MIN_CALLS,
+        open_seconds=BREAKER_OPEN_SECONDS,
+        timeout_percentile=BREAKER_TIMEOUT_PERCENTILE,
+        timeout_multiplier=BREAKER_TIMEOUT_MULTIPLIER,
+        min_timeout=BREAKER_MIN_TIMEOUT,
+        max_timeout=BREAKER_MAX_TIMEOUT
+    ) if BREAKER_ENABLED else None
+)
+# Last result per profile, served instead of an error while the circuit is open
+fallback_cache = FallbackCache(BREAKER_FALLBACK_ENTRIES) if BREAKER_ENABLED else None
+
+
+@asynccontextmanager
+async def llm_call(student: StudentInfo, priority: str, operation: str):
+    """Scheduler slot plus circuit breaker (with its adaptive timeout) around one generation"""
+    if breaker is None:
+        async with generation_slot(student, priority):
+            yield
+        return
+
+    # Fail fast rather than queueing for a slot while the circuit is open
+    breaker.check()
+    async with generation_slot(student, priority):
+        async with breaker.guard(operation):
+            yield
+
+
+def open_circuit_fallback(kind: str, student: StudentInfo):
+    """
+    None while calls are allowed. While the circuit is open, the cached result
+    for this profile, or CircuitOpenError if there is none.
+    """
+    if breaker is None:
+        return None
+    try:
+        breaker.check()
+        return None
+    except CircuitOpenError:
+        cached = fallback_cache.get(kind, student)
+        if cached is None:
+            raise
+        return cached
+
+
+def remember_result(kind: str, student: StudentInfo, value) -> None:
+    if fallback_cache is not None:
+        fallback_cache.put(kind, student, value)
+
+
+# ----------------------
+# Class (batch) generation
+# ----------------------
+class_generator = ClassPersonaGenerator(
+    llm,
+    PackSizer(BATCH_MAX_OUTPUT_TOKENS, BATCH_MAX_PACK_SIZE, BATCH_INITIAL_TOKENS_PER_STUDENT),
+    concurrency=BATCH_CONCURRENCY,
+    slot=generation_slot
+)
+
+# ----------------------
+# Speculative generation
+# ----------------------
+# Results generated while the form is being filled, waiting for a matching submit
+speculation_cache = (
+    SpeculationCache(SPECULATION_TTL_SECONDS, SPECULATION_MAX_ENTRIES) if SPECULATION_ENABLED else None
 )
 
 
@@ -39,52 +250,376 @@ llm = ChatOpenAI(
 async def show_form(request: Request):
     return templates.TemplateResponse("form.html", {
         "request": request,
-        "subjects": SUBJECTS_LIST
+        "subjects": SUBJECTS_LIST,
+        # Identifies this form's speculation so that edits can replace it
+        "speculation_session": secrets.token_urlsafe(16) if speculation_cache else None
     })
 
 class SimpleStreamingCallback(AsyncCallbackHandler):
-    """Minimal callback for stage indicators"""
+    """Minimal callback for stage indicators.
+
+    Events are queued as (type, frame) pairs with the frame already encoded
+    by the pipeline's encoder, so the consumer only has to write bytes.
+    """
     
-    def __init__(self, event_queue):
+    def __init__(self, event_queue, encoder, account=None):
         self.event_queue = event_queue
+        self.encoder = encoder
+        self.account = account
         self.word_count = 0
         self.start_time = None
+        # The whole response, kept for the circuit breaker's fallback cache
+        self.tokens = []
+        self.response_size = 0
+
+    async def _put(self, event_type: str, event: Event) -> None:
+        frame = self.encoder.encode(event) or b""
+        await self.event_queue.put((event_type, frame))
+        if self.account:
+            self.account.enqueued(len(frame), self.event_queue.qsize())
     
     async def on_llm_start(self, serialized, prompts, **kwargs) -> None:
         self.start_time = datetime.now()
-        await self.event_queue.put({
-            'type': 'stage',
-            'stage': 'thinking',
-            'message': 'AI is analyzing your profile...'
-        })
+        await self._put('stage', THINKING)
     
     async def on_llm_new_token(self, token: str, **kwargs) -> None:
         if self.word_count == 0:
-            await self.event_queue.put({
-                'type': 'stage',
-                'stage': 'streaming',
-                'message': 'Generating persona...'
-            })
+            await self._put('stage', STREAMING)
         
+        self.tokens.append(token)
+        if self.account:
+            self.response_size += len(token.encode("utf-8"))
+            self.account.retain("response_text", self.response_size)
+
         # Count words
         if token.strip():
             self.word_count += len(token.split())
         
         # Send token
-        await self.event_queue.put({
-            'type': 'token',
-            'content': token,
-            'word_count': self.word_count
-        })
+        await self._put('token', Event('token', {'content': token, 'word_count': self.word_count}))
     
     async def on_llm_end(self, response, **kwargs) -> None:
         elapsed = (datetime.now() - self.start_time).total_seconds() if self.start_time else 0
-        await self.event_queue.put({
-            'type': 'stage',
+        await self._put('complete', Event('stage', {
             'stage': 'complete',
             'message': 'Complete!',
             'elapsed': elapsed
-        })
+        }))
+
+
+# ----------------------
+# Pipeline stages
+# ----------------------
+# Shared by the persona endpoints; see pipeline.py for the engine and encoders
+async def validate_form_stage(ctx: PipelineContext):
+    # Stage 2: Processing
+    yield PROCESSING
+
+    # Create StudentInfo object
+    form_data = ctx.inputs["form"]
+    ctx.student = StudentInfo(**{**form_data, "favourite_subjects": form_data["favourite_subjects"] or []})
+    # Caches (circuit breaker fallback) are keyed by the normalised profile
+    ctx.profile = canonical_student(ctx.student)
+
+
+async def validate_ticket_stage(ctx: PipelineContext):
+    # Profile was already validated by htmx-setup
+    ctx.student = ctx.profile = handoff_store.get(ctx.inputs["ticket"])
+    if ctx.student is None:
+        raise PipelineError("This request has expired, please submit the form again.")
+
+
+def summarize_stage(pause: float = 0.0):
+    async def summarize(ctx: PipelineContext):
+        ctx.text_summary = student_text(ctx.student)
+        yield Event("summary", {"content": ctx.text_summary})
+        if pause:
+            # Force flush to ensure UI updates before blocking operation
+            await asyncio.sleep(pause)
+    return summarize
+
+
+async def persona_prompt_stage(ctx: PipelineContext):
+    ctx.prompt = create_persona_prompt(ctx.text_summary)
+
+
+async def generate_text_stage(ctx: PipelineContext):
+    """Plain-text persona streamed token by token (callback -> queue -> frames)"""
+    student, account = ctx.student, ctx.account
+
+    # While the circuit is open, the last persona written for this
+    # profile is replayed through the callback (or this fails fast)
+    cached_text = open_circuit_fallback("text", ctx.profile)
+
+    # Setup callback and queue
+    event_queue = asyncio.Queue()
+    callback = SimpleStreamingCallback(event_queue, ctx.encoder, account)
+    
+    # Initialize Langfuse LangChain callback handler for tracing
+    langfuse_handler = LangfuseCallbackHandler()
+    
+    # Build LCEL chain
+    chain = (
+        PromptTemplate.from_template(ctx.prompt)
+        | llm
+    )
+    
+    # Run chain in background task
+    async def run_chain():
+        try:
+            if cached_text is not None:
+                await callback.on_llm_start(None, [])
+                await callback.on_llm_new_token(cached_text)
+                await callback.on_llm_end(None)
+                return
+
+            # We use astream but rely on the callback for events
+            # We iterate to ensure execution, but ignore the direct chunks
+            # as the callback handles them
+            # Pass both callbacks: SimpleStreamingCallback for frontend streaming,
+            # LangfuseCallbackHandler for LLM tracing (prompt, output, tokens, cost)
+            async with llm_call(student, "interactive", "text_stream"):
+                async for _ in chain.astream(
+                    {"text_summary": ctx.text_summary},
+                    config={'callbacks': [ctx.usage, callback, langfuse_handler]}
+                ):
+                    pass
+        except Exception as e:
+            # The consumer re-raises it, so the pipeline reports it like any stage error
+            await event_queue.put(('error', e))
+        finally:
+            try:
+                # Flush Langfuse events in serverless environment
+                with diagnostics.stage("langfuse_flush"):
+                    get_client().flush()
+            finally:
+                # The consumer blocks on the queue instead of polling it; this wakes it for good
+                event_queue.put_nowait(('end', b''))
+
+    task = asyncio.create_task(run_chain())
+    account.track(event_queue, callback, langfuse_handler, chain, task)
+    
+    # Consume queue and yield frames
+    completed = False
+    try:
+        while True:
+            # Wait for next event
+            event_type, frame = await event_queue.get()
+            if event_type == 'end':
+                break
+            if event_type == 'error':
+                raise frame
+            account.dequeued(len(frame), event_queue.qsize())
+            
+            yield frame
+            
+            # If complete, we can stop after sending
+            if event_type == 'complete':
+                completed = True
+                if cached_text is None:
+                    remember_result("text", ctx.profile, "".join(callback.tokens))
+                break
+    finally:
+        # Stop generating if the client went away before completion; a
+        # completed run is left to finish its bookkeeping (breaker, flush)
+        if not task.done() and not completed:
+            task.cancel()
+
+
+async def generate_analysis_stage(ctx: PipelineContext):
+    """Structured PersonaAnalysis: speculation, circuit fallback, fan-out or a single call"""
+    student = ctx.student
+
+    # A profile speculated on while the form was filled is already
+    # generated (or on its way)
+    speculation = speculation_cache.claim(student) if speculation_cache else None
+    if speculation is not None:
+        with diagnostics.stage("speculation_wait"):
+            ctx.analysis = await speculation.result()
+        if ctx.analysis is not None:
+            # The tokens were spent for this request, just earlier
+            ctx.usage.absorb(speculation.counter)
+    if ctx.analysis is None:
+        ctx.analysis = open_circuit_fallback("analysis", student)
+    if ctx.analysis is not None:
+        return
+
+    if PERSONA_GENERATION_MODE == "fanout":
+        # --- FAN-OUT: one small call per card ---
+        # Cards replace their placeholders as soon as each call completes
+        yield Event("html", {"html": FANOUT_SKELETON_HTML})
+
+        langfuse_handler = LangfuseCallbackHandler()
+        results = asyncio.Queue()
+
+        # The calls run in their own task and hand sections over through a
+        # queue, so the scheduler slot and the breaker's timeout cover the
+        # LLM calls only, never time spent sending cards to a slow client
+        async def run_sections():
+            try:
+                async with llm_call(student, "interactive", "fanout"):
+                    async with aclosing(generate_sections(
+                        llm, student, ctx.text_summary, FANOUT_CONCURRENCY,
+                        config={
+                            'callbacks': [ctx.usage, langfuse_handler],
+                            'metadata': {'langfuse_session_id': ctx.inputs.get("ticket"), 'langfuse_tags': ['fanout']}
+                        }
+                    )) as generated:
+                        async for item in generated:
+                            results.put_nowait(item)
+            except Exception as e:
+                # Re-raised by the consumer, like generate_text_stage's errors
+                results.put_nowait(e)
+            finally:
+                results.put_nowait(None)
+
+        task = asyncio.create_task(run_sections())
+        ctx.account.track(langfuse_handler, results, task)
+
+        sections = {}
+        cards_size = 0
+        try:
+            while (item := await results.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                section, result = item
+                if not sections:
+                    # Update Stepper: Thinking -> Generating
+                    yield GENERATING
+                sections[section] = result
+
+                with diagnostics.stage("render"):
+                    card_html = render_section_card(templates, student, section, result)
+                cards_size += len(card_html)
+                ctx.account.retain("cards_html", cards_size)
+                yield Event("html", {"html": card_html})
+        finally:
+            # Outstanding calls are cancelled if the client went away
+            task.cancel()
+
+        # Full PersonaAnalysis, same as the single-call path produces
+        ctx.analysis = merge_sections(student, sections)
+        ctx.rendered = True
+    else:
+        # --- STRUCTURED DATA (JSON) ---
+        # The model writes only the free-text fields; method names, icons
+        # and the language preference are filled in locally.
+        # This will block while the model thinks/generates
+        chain = persona_draft_chain(llm)
+        ctx.account.track(chain)
+        async with llm_call(student, "interactive", "persona_draft"):
+            ctx.analysis = await generate_persona_analysis(
+                llm, student, text_summary=ctx.text_summary,
+                config={'callbacks': [ctx.usage]}, chain=chain
+            )
+    remember_result("analysis", student, ctx.analysis)
+
+
+async def render_dashboard_stage(ctx: PipelineContext):
+    if not ctx.rendered:
+        # Update Stepper: Thinking -> Generating
+        yield GENERATING
+
+        # We use Jinja2 to render the dashboard template with the data
+        dashboard_html = templates.get_template("_dashboard.html").render(analysis=ctx.analysis)
+
+        # Minify slightly to send over wire
+        dashboard_html = dashboard_html.replace('\n', ' ')
+        ctx.account.retain("dashboard_html", len(dashboard_html))
+
+        # Send the final HTML to the dashboard container
+        yield Event("html", {"html": dashboard_html})
+        ctx.rendered = True
+
+    # JSON and NDJSON clients get the structured result as well
+    yield Event("result", {"analysis": ctx.analysis})
+
+
+async def emit_done_stage(ctx: PipelineContext):
+    # Final done marker with timestamp, per-stage timings and token usage
+    timestamp = datetime.now().strftime("%B %d, %Y at %I:%M %p")
+    yield Event("done", {
+        "timestamp": timestamp,
+        "request_id": ctx.request_id,
+        "timings": {stage: round(elapsed, 4) for stage, elapsed in ctx.timings.items()},
+        "usage": ctx.usage.summary()
+    })
+
+
+async def validate_class_stage(ctx: PipelineContext):
+    # Identical submissions are generated once
+    ctx.students = [canonical_student(s) for s in ctx.inputs["students"]]
+    tenants = {tenant_of(s, SCHEDULER_TENANT_KEY) for s in ctx.students}
+    ctx.tenant = tenants.pop() if len(tenants) == 1 else "mixed"
+
+
+async def generate_class_stage(ctx: PipelineContext):
+    """Whole class, packing several students into each LLM call"""
+    unique = {profile_key(s): s for s in ctx.students}
+    langfuse_handler = LangfuseCallbackHandler()
+    try:
+        results = await class_generator.generate(
+            list(unique.values()),
+            config={'callbacks': [ctx.usage, langfuse_handler]}
+        )
+    finally:
+        with diagnostics.stage("langfuse_flush"):
+            get_client().flush()
+    ctx.analysis = dict(zip(unique.keys(), results))
+
+
+async def emit_class_stage(ctx: PipelineContext):
+    yield Event("result", {
+        "results": [{"student": student, **ctx.analysis[profile_key(student)]} for student in ctx.students],
+        "request_id": ctx.request_id,
+        "usage": ctx.usage.summary()
+    })
+
+
+stage_timings = StageTimings()
+
+# Plain-text persona streamed token by token
+text_pipeline = Pipeline("text", [
+    ("validate", validate_form_stage),
+    ("summarize", summarize_stage()),
+    ("prompt", persona_prompt_stage),
+    ("generate", generate_text_stage),
+    ("emit", emit_done_stage),
+], hooks=[stage_timings, usage_ledger])
+
+# Structured persona rendered as the dashboard
+analysis_pipeline = Pipeline("analysis", [
+    ("validate", validate_ticket_stage),
+    ("summarize", summarize_stage(pause=0.2)),
+    ("generate", generate_analysis_stage),
+    ("render", render_dashboard_stage),
+    ("emit", emit_done_stage),
+], hooks=[stage_timings, usage_ledger])
+
+# Personas for a whole class, returned as one JSON document
+class_pipeline = Pipeline("class", [
+    ("validate", validate_class_stage),
+    ("generate", generate_class_stage),
+    ("emit", emit_class_stage),
+], hooks=[stage_timings, usage_ledger])
+
+
+def stream_pipeline(pipeline: Pipeline, ctx: PipelineContext) -> StreamingResponse:
+    # Sent instead of the rest of the stream if a drain's grace period runs out
+    draining = DrainingError(drainer.retry_after)
+    abort_frame = ctx.encoder.encode(Event("error", {"message": str(draining), "retry_after": draining.retry_after}))
+    return HeartbeatResponse(
+        drainer.guard(stream_registry.watch(ctx.account, pipeline.run(ctx)), abort_frame),
+        heartbeat=heartbeat,
+        heartbeat_frame=ctx.encoder.heartbeat,
+        media_type=ctx.encoder.media_type,
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no"  # Disable nginx buffering
+        }
+    )
+
 
 # ----------------------
 # HTMX Streaming Endpoints
@@ -100,25 +635,37 @@ async def htmx_setup(
     favourite_subjects: Optional[List[str]] = Query(None),
     study_frequency: str = Query(...)
 ):
-    # Construct the query string for the stream
-    from urllib.parse import urlencode
-    
-    params = {
-        "name": name,
-        "gender": gender,
-        "form": form,
-        "school": school,
-        "preferred_language": preferred_language,
-        "study_frequency": study_frequency
-    }
-    
-    # Helper to build URL with list params
-    query_string = urlencode(params)
-    if favourite_subjects:
-        for subject in favourite_subjects:
-            query_string += f"&favourite_subjects={subject}"
-            
-    stream_url = f"/persona/stream-htmx?{query_string}"
+    # New generations go to another instance while this one drains
+    try:
+        drainer.check()
+    except DrainingError as e:
+        return HTMLResponse(f"""
+    <div class="results-container show results-wide" id="resultsContainer">
+        <div id="errorContainer">Error: {e}</div>
+    </div>
+    """, headers={"Retry-After": str(round(e.retry_after))})
+
+    # Validate once and hand the profile over to the stream via a ticket
+    try:
+        with diagnostics.stage("validate"):
+            student = canonical_student(StudentInfo(
+                name=name,
+                gender=gender,
+                form=form,
+                school=school,
+                preferred_language=preferred_language,
+                favourite_subjects=favourite_subjects or [],
+                study_frequency=study_frequency
+            ))
+    except ValidationError as e:
+        return f"""
+    <div class="results-container show results-wide" id="resultsContainer">
+        <div id="errorContainer">Error: {e.error_count()} invalid field(s) in the submitted form</div>
+    </div>
+    """
+
+    ticket = handoff_store.put(student)
+    stream_url = f"/persona/stream-htmx?ticket={ticket}"
     
     return f"""
     <div class="results-container show results-wide" id="resultsContainer">
@@ -179,134 +726,78 @@ async def htmx_setup(
     </div>
     """
 
-@app.get("/persona/stream-htmx")
-async def generate_persona_stream_htmx(
-    request: Request,
-    name: str = Query(...),
-    gender: str = Query(...),
-    form: str = Query(...),
-    school: str = Query(...),
-    preferred_language: str = Query(...),
+async def speculative_generate(student: StudentInfo, callbacks: list):
+    """Background generation for a speculation; always a single structured call"""
+    langfuse_handler = LangfuseCallbackHandler()
+    try:
+        async with llm_call(student, "speculative", "persona_draft"):
+            with diagnostics.stage("speculate"):
+                return await generate_persona_analysis(
+                    llm, student,
+                    config={
+                        'callbacks': callbacks + [langfuse_handler],
+                        'metadata': {'langfuse_tags': ['speculative']}
+                    }
+                )
+    finally:
+        with diagnostics.stage("langfuse_flush"):
+            get_client().flush()
+
+
+@app.get("/persona/prefetch", dependencies=[Depends(accepting_generations)])
+async def persona_prefetch(
+    speculation_session: str = Query(...),
+    name: str = Query(""),
+    gender: str = Query(""),
+    form: str = Query(""),
+    school: str = Query(""),
+    preferred_language: str = Query(""),
     favourite_subjects: Optional[List[str]] = Query(None),
-    study_frequency: str = Query(...)
+    study_frequency: str = Query("")
 ):
-    async def generate_stream():
-        try:
-            # 1. RECEIVED -> THINKING
-            # Initial state is already set in HTML, so we just proceed to sending summary
-            
-            subjects_list = favourite_subjects or []
-            student = StudentInfo(
-                name=name,
-                gender=gender,
-                form=form,
-                school=school,
-                preferred_language=preferred_language,
-                favourite_subjects=subjects_list,
-                study_frequency=study_frequency
-            )
-            
-            text_summary = student_text(student)
-            
-            # Start Generation
-            prompt_str = create_persona_prompt(text_summary)
-            
-            # --- PHASE 1: THINKING (Show Summary) ---
-            # Since native reasoning tokens are hidden, we display the input summary
-            # to give context while the user waits.
-            
-            summary_html = text_summary.replace('\n', '<br>')
-            safe_summary_json = json.dumps(summary_html)
-            
-            # Construct single-line script payload
-            script_content = (
-                f"var box = document.getElementById('studentSummaryBox'); "
-                f"var content = document.getElementById('studentSummaryContent'); "
-                f"if (box && content) {{ "
-                f"box.style.display = 'block'; "
-                f"content.innerHTML = '<strong>Summary being analyzed:</strong><br>' + {safe_summary_json} + '<br><br><em>Generating persona...</em>'; "
-                f"}}"
-            )
-            
-            yield f"event: stage\ndata: <script>{script_content}</script>\n\n"
-
-            # Force flush to ensure UI updates before blocking operation
-            await asyncio.sleep(0.2)
+    """Debounced from the form while it is being filled: speculate on the profile so far"""
+    if not speculation_cache:
+        raise HTTPException(status_code=404)
 
-            # --- PHASE 2: STRUCTURED DATA (JSON) ---
-            # We use standard structured output. 
-            structured_llm = llm.with_structured_output(PersonaAnalysis)
-            
-            structured_chain = (
-                PromptTemplate.from_template("{prompt_str}")
-                | structured_llm
-            )
-            
-            # This will block while the model thinks/generates
-            analysis_result = await structured_chain.ainvoke({
-                "prompt_str": prompt_str
-            })
-            
-            # Update Stepper: Thinking -> Generating
-            script_generating = (
-                "document.getElementById('step-thinking').classList.remove('active'); "
-                "document.getElementById('step-thinking').classList.add('completed'); "
-                "document.getElementById('step-generating').classList.add('active'); "
-                "var summaryBox = document.getElementById('studentSummaryBox'); "
-                "if(summaryBox) summaryBox.style.display = 'none';"
-            )
-            yield f"event: stage\ndata: <script>{script_generating}</script>\n\n"
-            
-            # --- PHASE 3: RENDER HTML ---
-            # We use Jinja2 to render the dashboard template with the data
-            dashboard_html = templates.get_template("_dashboard.html").render(analysis=analysis_result)
-            
-            # Minify slightly to send over wire
-            dashboard_html = dashboard_html.replace('\n', ' ')
-            
-            # Send the final HTML to the dashboard container
-            yield f"event: token\ndata: {dashboard_html}\n\n"
-            
-            # 4. COMPLETE
-            elapsed = 0 
-            timestamp = datetime.now().strftime("%B %d, %Y at %I:%M %p")
-            
-            # Send complete event to update UI
-            script_complete = (
-                "document.getElementById('step-generating').classList.remove('active'); "
-                "document.getElementById('step-generating').classList.add('completed'); "
-                "document.getElementById('step-complete').classList.add('completed'); "
-                f"document.getElementById('resultTimestamp').innerHTML = 'Generated on {timestamp}'; "
-                "document.getElementById('resultTimestamp').style.display='block'; "
-                "document.getElementById('restartBtn').style.display='block';"
-            )
-            yield f"event: stage\ndata: <script>{script_complete}</script>\n\n"
-                         
-            yield f"""event: done
-data: <div id="sse-connection-closed"></div>
+    with diagnostics.stage("validate"):
+        student = canonical_student(StudentInfo(
+            name=name,
+            gender=gender,
+            form=form,
+            school=school,
+            preferred_language=preferred_language,
+            favourite_subjects=favourite_subjects or [],
+            study_frequency=study_frequency
+        ))
 
-"""
-                    
-        except Exception as e:
-            yield f"""event: error
-data: Error: {str(e)}
+    # Only complete profiles are worth generating for; an incomplete one means
+    # the user is still editing, so any earlier speculation is stale
+    if all(student.model_dump().values()):
+        speculation_cache.speculate(speculation_session, student, speculative_generate)
+    else:
+        speculation_cache.forget(speculation_session)
+    return Response(status_code=204)
 
-"""
 
-    return StreamingResponse(
-        generate_stream(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"
-        }
+@app.get("/persona/stream-htmx", dependencies=[Depends(accepting_generations)])
+async def generate_persona_stream_htmx(
+    request: Request,
+    ticket: str = Query(...)
+):
+    ctx = PipelineContext(
+        "/persona/stream-htmx",
+        HtmxSseEncoder(),
+        account=stream_registry.open("/persona/stream-htmx"),
+        usage=UsageCounter(pricing),
+        ticket=ticket
     )
+    return stream_pipeline(analysis_pipeline, ctx)
+
 
 # ----------------------
 # Streaming Endpoint
 # ----------------------
-@app.post("/persona/stream/")
+@app.post("/persona/stream/", dependencies=[Depends(accepting_generations)])
 async def generate_persona_stream(
     request: Request,
     name: str = Form(...),
@@ -315,118 +806,157 @@ async def generate_persona_stream(
     school: str = Form(...),
     preferred_language: str = Form(...),
     favourite_subjects: Optional[List[str]] = Form(None),
-    study_frequency: str = Form(...)
+    study_frequency: str = Form(...),
+    output: str = Query("sse", alias="format", pattern="^(sse|ndjson)$")
 ):
-    """Streaming version of persona generation for Vercel timeout handling"""
-    
-    async def generate_stream():
-        try:
-            # Stage 2: Processing
-            yield f"data: {json.dumps({
-                'type': 'stage',
-                'stage': 'processing',
-                'message': 'Processing student information...'
-            })}\n\n"
-            
-            # Step 1: Create StudentInfo object
-            subjects_list = favourite_subjects or []
-            
-            student = StudentInfo(
-                name=name,
-                gender=gender,
-                form=form,
-                school=school,
-                preferred_language=preferred_language,
-                favourite_subjects=subjects_list,
-                study_frequency=study_frequency
-            )
-            
-            # Step 2: Create student text summary
-            text_summary = student_text(student)
-            
-            # Step 3: Send student summary
-            yield f"data: {json.dumps({'type': 'summary', 'content': text_summary})}\n\n"
-            
-            # Step 4: Setup callback and queue
-            event_queue = asyncio.Queue()
-            callback = SimpleStreamingCallback(event_queue)
-            
-            # Initialize Langfuse LangChain callback handler for tracing
-            langfuse_handler = LangfuseCallbackHandler()
-            
-            # Step 5: Build prompt
-            prompt_str = create_persona_prompt(text_summary)
-            
-            # Step 6: Build LCEL chain
-            chain = (
-                PromptTemplate.from_template(prompt_str)
-                | llm
-            )
-            
-            # Step 7: Run chain in background task
-            async def run_chain():
-                try:
-                    # We use astream but rely on the callback for events
-                    # We iterate to ensure execution, but ignore the direct chunks
-                    # as the callback handles them
-                    # Pass both callbacks: SimpleStreamingCallback for frontend streaming,
-                    # LangfuseCallbackHandler for LLM tracing (prompt, output, tokens, cost)
-                    async for _ in chain.astream(
-                        {"text_summary": text_summary},
-                        config={'callbacks': [callback, langfuse_handler]}
-                    ):
-                        pass
-                except Exception as e:
-                    await event_queue.put({
-                        'type': 'error',
-                        'message': str(e)
-                    })
-                finally:
-                    # Flush Langfuse events in serverless environment
-                    get_client().flush()
-
-            task = asyncio.create_task(run_chain())
-            
-            # Step 8: Consume queue and yield events
-            while not task.done() or not event_queue.empty():
-                try:
-                    # Wait for next event
-                    event = await asyncio.wait_for(
-                        event_queue.get(),
-                        timeout=0.1
-                    )
-                    
-                    yield f"data: {json.dumps(event)}\n\n"
-                    
-                    # If complete or error, we can break after sending
-                    if event['type'] == 'stage' and event['stage'] == 'complete':
-                        # Send final done marker with timestamp
-                        timestamp = datetime.now().strftime("%B %d, %Y at %I:%M %p")
-                        yield f"data: {json.dumps({'type': 'done', 'timestamp': timestamp})}\n\n"
-                        break
-                    
-                    if event['type'] == 'error':
-                        break
-                        
-                except asyncio.TimeoutError:
-                    continue
-                except Exception as e:
-                    yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
-                    break
-            
-        except Exception as e:
-            # Send error to client
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
-    
-    return StreamingResponse(
-        generate_stream(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"  # Disable nginx buffering
+    """Streaming version of persona generation for Vercel timeout handling (?format=ndjson for NDJSON)"""
+    ctx = PipelineContext(
+        "/persona/stream/",
+        ENCODERS[output](),
+        account=stream_registry.open("/persona/stream/"),
+        usage=UsageCounter(pricing),
+        form={
+            "name": name,
+            "gender": gender,
+            "form": form,
+            "school": school,
+            "preferred_language": preferred_language,
+            "favourite_subjects": favourite_subjects,
+            "study_frequency": study_frequency,
         }
     )
+    return stream_pipeline(text_pipeline, ctx)
+
+
+
+# ----------------------
+# Class Endpoint
+# ----------------------
+@app.post("/persona/class", dependencies=[Depends(accepting_generations)])
+async def generate_class_personas(students: List[StudentInfo]):
+    """Generate personas for a whole class, packing several students into each LLM call"""
+    ctx = PipelineContext("/persona/class", JsonEncoder(), usage=UsageCounter(pricing), students=students)
+    body = b"".join([frame async for frame in class_pipeline.run(ctx)])
+    return Response(body, status_code=500 if ctx.outcome == "error" else 200, media_type=ctx.encoder.media_type)
+
+
+# ----------------------
+# Admin Endpoints
+# ----------------------
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Admin endpoints only exist when ADMIN_TOKEN is configured."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404)
+    if x_admin_token is None or not secrets.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+@app.get("/admin/drain", dependencies=[Depends(require_admin)])
+async def drain_stats():
+    """Whether the app is draining, and streams completed, drained and aborted"""
+    return drainer.summary()
+
+
+@app.post("/admin/drain", dependencies=[Depends(require_admin)])
+async def start_drain():
+    """Start draining ahead of SIGTERM (e.g. from a pre-stop hook)"""
+    drainer.start("admin")
+    return drainer.summary()
+
+
+@app.get("/admin/heartbeat", dependencies=[Depends(require_admin)])
+async def heartbeat_stats():
+    """Streams watched by the heartbeat wheel and keepalives sent"""
+    if not heartbeat:
+        raise HTTPException(status_code=404, detail="Heartbeats are disabled")
+    return heartbeat.summary()
+
+
+@app.get("/admin/pipeline", dependencies=[Depends(require_admin)])
+async def pipeline_stats():
+    """Per-stage durations and run outcomes of the streaming pipelines"""
+    return stage_timings.summary()
+
+
+@app.get("/admin/usage", dependencies=[Depends(require_admin)])
+async def usage_stats():
+    """Token usage and cost per endpoint and tenant, and the most expensive recent requests"""
+    return usage_ledger.summary()
+
+
+@app.get("/admin/breaker", dependencies=[Depends(require_admin)])
+async def breaker_stats():
+    """Circuit state, time in each state, transitions and the current adaptive timeouts"""
+    if not breaker:
+        raise HTTPException(status_code=404, detail="Circuit breaker is disabled")
+    return {**breaker.summary(), "fallbacks_served": fallback_cache.served}
+
+
+@app.get("/admin/scheduler", dependencies=[Depends(require_admin)])
+async def scheduler_stats():
+    """Per-tenant queue depth, wait and service times, by priority"""
+    if not scheduler:
+        raise HTTPException(status_code=404, detail="Scheduling is disabled")
+    return scheduler.summary()
+
+
+@app.get("/admin/speculation", dependencies=[Depends(require_admin)])
+async def speculation_stats():
+    """Speculation hit rate and the tokens spent on speculations nobody submitted"""
+    if not speculation_cache:
+        raise HTTPException(status_code=404, detail="Speculation is disabled")
+    return speculation_cache.summary()
+
+
+@app.get("/admin/diagnostics/lag", dependencies=[Depends(require_admin)])
+async def diagnostics_lag():
+    """Event-loop lag percentiles and recent stalls with their blocking stacks"""
+    if not diagnostics.lag_monitor:
+        raise HTTPException(status_code=404, detail="Diagnostics are disabled")
+    return diagnostics.lag_monitor.summary()
+
+
+@app.get("/admin/diagnostics/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+async def diagnostics_profile(profile_id: str):
+    """Folded stacks for a profiled request (flamegraph.pl / speedscope input)"""
+    folded = diagnostics.profiles.get(profile_id)
+    if folded is None:
+        raise HTTPException(status_code=404, detail="Unknown or still running profile")
+    return PlainTextResponse(folded)
+
+
+@app.get("/admin/memory/streams", dependencies=[Depends(require_admin)])
+async def memory_streams(check_leaks: bool = False):
+    """Per-stream held bytes and queue lengths; optionally closed streams that were not released"""
+    summary = stream_registry.summary()
+    if check_leaks:
+        summary["leaks"] = stream_registry.find_leaks()
+    return summary
+
+
+@app.post("/admin/memory/snapshots", dependencies=[Depends(require_admin)])
+async def memory_snapshot():
+    """Take a tracemalloc snapshot (starts tracing on first use)"""
+    return snapshot_store.take()
+
+
+@app.get("/admin/memory/snapshots/diff", dependencies=[Depends(require_admin)])
+async def memory_snapshot_diff(
+    from_id: str = Query(..., alias="from"),
+    to_id: str = Query(..., alias="to"),
+    by: str = Query("module", pattern="^(module|package)$")
+):
+    """Allocation growth between two snapshots, grouped by module or package"""
+    if from_id not in snapshot_store.snapshots or to_id not in snapshot_store.snapshots:
+        raise HTTPException(status_code=404, detail="Unknown snapshot id")
+    return snapshot_store.diff(from_id, to_id, by=by)
+
+
+@app.delete("/admin/memory/snapshots", dependencies=[Depends(require_admin)])
+async def memory_snapshots_clear():
+    """Drop stored snapshots and stop tracemalloc"""
+    snapshot_store.clear()
+    return {"cleared": True}
 
 
 # # ----------------------
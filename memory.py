@@ -0,0 +1,241 @@
+"""
+Per-stream memory accounting and tracemalloc snapshots.
+
+Every SSE stream opens a StreamAccount that records the bytes it is holding
+(queued frames, the accumulated response text and retained results), its
+peak queue length and weak
+references to the objects it owns (queue, callbacks, chain). After a stream
+closes those objects should be collectable; find_leaks() reports the ones
+that are still alive, so cancelled and errored streams can be checked.
+"""
+import gc
+import itertools
+import sys
+import time
+import tracemalloc
+import weakref
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+
+
+class StreamAccount:
+    """
+    bytes_held is an estimate of the payload bytes a stream holds (encoded
+    frames, UTF-8 text and HTML), not its allocated memory: Python object
+    overhead, the LLM client's buffers and the objects in track() are not
+    counted. Use tracemalloc snapshots to size workers.
+    """
+
+    def __init__(self, stream_id: int, endpoint: str):
+        self.stream_id = stream_id
+        self.endpoint = endpoint
+        self.opened_at = time.time()
+        self.closed_at: Optional[float] = None
+        self.outcome: Optional[str] = None
+        self.bytes_held = 0
+        self.peak_bytes_held = 0
+        self.queue_len = 0
+        self.peak_queue_len = 0
+        self.bytes_sent = 0
+        self.errored = False
+        self._retained: Dict[str, int] = {}
+        self._refs: List[weakref.ref] = []
+
+    def track(self, *objects) -> None:
+        """Watch objects that must be released once the stream closes."""
+        for obj in objects:
+            try:
+                self._refs.append(weakref.ref(obj))
+            except TypeError:
+                # Builtins such as str do not support weak references
+                pass
+
+    def enqueued(self, size: int, queue_len: int) -> None:
+        self.queue_len = queue_len
+        self.peak_queue_len = max(self.peak_queue_len, queue_len)
+        self._add(size)
+
+    def dequeued(self, size: int, queue_len: int) -> None:
+        self.queue_len = queue_len
+        self._add(-size)
+
+    def retain(self, name: str, size: int) -> None:
+        """Record a result held for the rest of the stream (replaces a previous value)."""
+        self._add(size - self._retained.get(name, 0))
+        self._retained[name] = size
+
+    def sent(self, size: int) -> None:
+        self.bytes_sent += size
+
+    def mark_error(self) -> None:
+        self.errored = True
+
+    def _add(self, size: int) -> None:
+        self.bytes_held += size
+        self.peak_bytes_held = max(self.peak_bytes_held, self.bytes_held)
+
+    def alive_objects(self) -> List[str]:
+        return [type(obj).__name__ for ref in self._refs if (obj := ref()) is not None]
+
+    def to_dict(self) -> dict:
+        return {
+            "stream_id": self.stream_id,
+            "endpoint": self.endpoint,
+            "age_s": round((self.closed_at or time.time()) - self.opened_at, 2),
+            "outcome": self.outcome,
+            "bytes_held": self.bytes_held,
+            "peak_bytes_held": self.peak_bytes_held,
+            "queue_len": self.queue_len,
+            "peak_queue_len": self.peak_queue_len,
+            "bytes_sent": self.bytes_sent,
+        }
+
+
+class StreamRegistry:
+    def __init__(self, closed_history: int = 1000):
+        self.open_streams: Dict[int, StreamAccount] = {}
+        self.closed_streams: deque = deque(maxlen=closed_history)
+        self.outcomes: Dict[str, int] = {}
+        self.peak_open = 0
+        self.peak_queue_len = 0
+        self._ids = itertools.count(1)
+
+    def open(self, endpoint: str) -> StreamAccount:
+        account = StreamAccount(next(self._ids), endpoint)
+        self.open_streams[account.stream_id] = account
+        self.peak_open = max(self.peak_open, len(self.open_streams))
+        return account
+
+    def close(self, account: StreamAccount, outcome: str) -> None:
+        if account.outcome is not None:
+            return
+        account.outcome = outcome
+        account.closed_at = time.time()
+        # Retained results are released with the stream
+        account.bytes_held = 0
+        self.open_streams.pop(account.stream_id, None)
+        self.closed_streams.append(account)
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        self.peak_queue_len = max(self.peak_queue_len, account.peak_queue_len)
+
+    async def watch(self, account: StreamAccount, frames):
+        """
+        Pass frames through to the response, counting bytes sent, and close
+        the account when the stream ends: "done", "error" (the stream called
+        mark_error) or "cancelled" (client went away mid-stream).
+        """
+        outcome = "cancelled"
+        try:
+            async for frame in frames:
+                account.sent(len(frame))
+                yield frame
+            outcome = "error" if account.errored else "done"
+        finally:
+            # Run the inner generator's cleanup before the account is closed
+            await frames.aclose()
+            self.close(account, outcome)
+
+    def find_leaks(self) -> List[dict]:
+        """Closed streams whose tracked objects are still reachable after a full GC."""
+        gc.collect()
+        leaks = []
+        for account in self.closed_streams:
+            alive = account.alive_objects()
+            if alive:
+                leaks.append({**account.to_dict(), "alive": alive})
+        return leaks
+
+    def summary(self) -> dict:
+        open_accounts = list(self.open_streams.values())
+        held = sum(a.bytes_held for a in open_accounts)
+        return {
+            "open_streams": len(open_accounts),
+            "peak_open_streams": self.peak_open,
+            "bytes_held": held,
+            "avg_bytes_held_per_stream": held // len(open_accounts) if open_accounts else 0,
+            "peak_queue_len": max([self.peak_queue_len] + [a.peak_queue_len for a in open_accounts]),
+            "outcomes": dict(self.outcomes),
+            "streams": [a.to_dict() for a in open_accounts],
+        }
+
+
+# ----------------------
+# tracemalloc snapshots
+# ----------------------
+class SnapshotStore:
+    """Named tracemalloc snapshots, diffed and grouped by module."""
+
+    def __init__(self, limit: int = 10, frames: int = 1):
+        self.limit = limit
+        self.frames = frames
+        self.snapshots: "OrderedDict[str, tracemalloc.Snapshot]" = OrderedDict()
+        self._ids = itertools.count(1)
+
+    def take(self) -> dict:
+        started = not tracemalloc.is_tracing()
+        if started:
+            # Tracing only sees allocations made after it starts, so the first
+            # snapshot is a baseline for the ones that follow
+            tracemalloc.start(self.frames)
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ])
+        snapshot_id = str(next(self._ids))
+        self.snapshots[snapshot_id] = snapshot
+        while len(self.snapshots) > self.limit:
+            self.snapshots.popitem(last=False)
+
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "snapshot_id": snapshot_id,
+            "tracing_started": started,
+            "traced_bytes": current,
+            "traced_peak_bytes": peak,
+        }
+
+    def diff(self, from_id: str, to_id: str, by: str = "module", limit: int = 25) -> dict:
+        """Size change per module (or top-level package with by="package")."""
+        old = self.snapshots[from_id]
+        new = self.snapshots[to_id]
+        modules = _module_names()
+
+        grouped: Dict[str, List[int]] = {}
+        for stat in new.compare_to(old, "filename"):
+            filename = stat.traceback[0].filename
+            module = modules.get(filename, filename)
+            if by == "package" and filename in modules:
+                module = module.split(".")[0]
+            entry = grouped.setdefault(module, [0, 0, 0])
+            entry[0] += stat.size_diff
+            entry[1] += stat.size
+            entry[2] += stat.count_diff
+
+        ranked = sorted(grouped.items(), key=lambda item: abs(item[1][0]), reverse=True)
+        return {
+            "from": from_id,
+            "to": to_id,
+            "by": by,
+            "total_size_diff": sum(entry[0] for entry in grouped.values()),
+            "modules": [
+                {"module": module, "size_diff": size_diff, "size": size, "count_diff": count_diff}
+                for module, (size_diff, size, count_diff) in ranked[:limit]
+            ],
+        }
+
+    def clear(self) -> None:
+        self.snapshots.clear()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def _module_names() -> Dict[str, str]:
+    names = {}
+    for name, module in list(sys.modules.items()):
+        filename = getattr(module, "__file__", None)
+        if filename:
+            names[filename] = name
+    return names
+
+
+stream_registry = StreamRegistry()
+snapshot_store = SnapshotStore()
@@ -38,3 +38,37 @@ class PersonaAnalysis(BaseModel):
     student_persona: str = Field(..., description="A concise paragraph describing the student's personality, study preferences, and life vision.")
     language_preference: str = Field(..., description="Conclusion on the primary studying language based on the rules.")
     learning_methods: List[LearningMethod] = Field(..., description="A list of 6 recommended learning methods.")
+
+# --- Reduced LLM output (hybrid pipeline) ---
+# Only the free-text parts of PersonaAnalysis are generated by the model;
+# method names, icons and the language preference are filled in locally.
+
+class MethodDraft(BaseModel):
+    """Model-written part of one learning method card."""
+    rationale: str = Field(..., description="Why this method fits this specific student's profile.")
+    example: str = Field(..., description="A concrete example of applying this method to the student's subjects.")
+
+class PersonaDraft(BaseModel):
+    """The parts of a persona analysis that need the model."""
+    student_persona: str = Field(..., description="A concise paragraph describing the student's personality, study preferences, and life vision.")
+    feynman: MethodDraft = Field(..., description="Feynman Technique")
+    mnemonic: MethodDraft = Field(..., description="Mnemonics")
+    visualisation: MethodDraft = Field(..., description="Visualisation")
+    contextual: MethodDraft = Field(..., description="Contextual Learning")
+    key_points: MethodDraft = Field(..., description="Key Points")
+    spaced_repetition: MethodDraft = Field(..., description="Spaced Repetition")
+
+class PersonaParagraph(BaseModel):
+    """Persona section generated on its own in fan-out mode."""
+    student_persona: str = Field(..., description="A concise paragraph describing the student's personality, study preferences, and life vision.")
+
+# --- Class (batch) generation ---
+
+class StudentPersonaEntry(BaseModel):
+    """Persona draft for one student in a class request."""
+    student_id: str = Field(..., description="The student id exactly as given in the input list (e.g., 'S1').")
+    draft: PersonaDraft
+
+class ClassPersonaAnalysis(BaseModel):
+    """Persona analyses for every student in a class request."""
+    personas: List[StudentPersonaEntry] = Field(..., description="One entry per student in the input list, in the same order.")
@@ -0,0 +1,236 @@
+"""
+Staged streaming pipeline shared by the persona endpoints.
+
+A pipeline is a list of named async stages (validate -> summarize -> prompt
+-> generate -> render -> emit). Each stage reads and fills the shared
+PipelineContext and yields Events; an encoder turns events into the bytes
+of one wire format (JSON SSE, HTMX SSE, NDJSON or a single JSON document),
+so the same stages serve every output. Hot paths may yield frames they
+already encoded with ctx.encoder. A stage that only fills the context can
+be a plain coroutine.
+
+The engine times every stage (reported to hooks such as StageTimings),
+labels it for diagnostics, turns any exception into an error event, and
+closes the running stage when the client goes away so that the stage's own
+cleanup (cancelling its LLM task) runs immediately.
+"""
+import inspect
+import time
+import uuid
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, NamedTuple, Optional, Sequence, Tuple, Union
+import diagnostics
+from stats import percentiles
+from serialization import (
+    dumps, sse_data, sse_event, sse_script, sse_token,
+    STAGE_PROCESSING, STAGE_THINKING, STAGE_STREAMING, HTMX_STAGE_GENERATING, HTMX_DONE, SSE_HEARTBEAT
+)
+
+
+class Event(NamedTuple):
+    # stage | summary | token | html | result | done | error
+    kind: str
+    data: Dict[str, Any]
+
+
+PROCESSING = Event("stage", {"stage": "processing", "message": "Processing student information..."})
+THINKING = Event("stage", {"stage": "thinking", "message": "AI is analyzing your profile..."})
+STREAMING = Event("stage", {"stage": "streaming", "message": "Generating persona..."})
+GENERATING = Event("stage", {"stage": "generating", "message": "Rendering persona..."})
+
+
+class PipelineError(Exception):
+    """Expected failure whose message is shown to the user as is."""
+
+
+# ----------------------
+# Encoders
+# ----------------------
+class JsonSseEncoder:
+    """Unnamed SSE frames with JSON payloads (/persona/stream/)."""
+    media_type = "text/event-stream"
+    heartbeat = SSE_HEARTBEAT
+
+    def encode(self, event: Event) -> Optional[bytes]:
+        kind, data = event
+        if kind == "token":
+            return sse_token(data["content"], data["word_count"])
+        # The standard stage events have pre-encoded frames
+        if event is PROCESSING:
+            return STAGE_PROCESSING
+        if event is THINKING:
+            return STAGE_THINKING
+        if event is STREAMING:
+            return STAGE_STREAMING
+        if kind == "html":
+            return None
+        return sse_data({"type": kind, **data})
+
+
+class HtmxSseEncoder:
+    """Named SSE events carrying HTML and scripts for the htmx sse extension (/persona/stream-htmx)."""
+    media_type = "text/event-stream"
+    heartbeat = SSE_HEARTBEAT
+
+    def encode(self, event: Event) -> Optional[bytes]:
+        kind, data = event
+        if kind == "html":
+            return sse_event("token", data["html"])
+        if kind == "stage":
+            # The other stages are already shown by the setup HTML
+            return HTMX_STAGE_GENERATING if data.get("stage") == "generating" else None
+        if kind == "summary":
+            # Since native reasoning tokens are hidden, we display the input summary
+            # to give context while the user waits.
+            safe_summary_json = dumps(data["content"].replace('\n', '<br>')).decode("utf-8")
+            return sse_script(
+                f"var box = document.getElementById('studentSummaryBox'); "
+                f"var content = document.getElementById('studentSummaryContent'); "
+                f"if (box && content) {{ "
+                f"box.style.display = 'block'; "
+                f"content.innerHTML = '<strong>Summary being analyzed:</strong><br>' + {safe_summary_json} + '<br><br><em>Generating persona...</em>'; "
+                f"}}"
+            )
+        if kind == "done":
+            script = (
+                "document.getElementById('step-generating').classList.remove('active'); "
+                "document.getElementById('step-generating').classList.add('completed'); "
+                "document.getElementById('step-complete').classList.add('completed'); "
+                f"document.getElementById('resultTimestamp').innerHTML = 'Generated on {data['timestamp']}'; "
+                "document.getElementById('resultTimestamp').style.display='block'; "
+                "document.getElementById('restartBtn').style.display='block';"
+            )
+            if data.get("usage"):
+                # Token usage is kept on the page for inspection, not displayed
+                usage_json = dumps(dumps(data["usage"]).decode("utf-8")).decode("utf-8")
+                script += f" document.getElementById('resultTimestamp').dataset.usage = {usage_json};"
+            script_complete = sse_script(script)
+            return script_complete + HTMX_DONE
+        if kind == "error":
+            return sse_event("error", f"Error: {data['message']}")
+        # Raw tokens and the structured result are not shown by the htmx page
+        return None
+
+
+class NdjsonEncoder:
+    """One JSON object per line, for clients that do not speak SSE."""
+    media_type = "application/x-ndjson"
+    # No comment syntax, and a blank line is not valid NDJSON everywhere
+    heartbeat = None
+
+    def encode(self, event: Event) -> Optional[bytes]:
+        return dumps({"type": event.kind, **event.data}) + b"\n"
+
+
+class JsonEncoder:
+    """One JSON document holding the result, or the error (/persona/class)."""
+    media_type = "application/json"
+    heartbeat = None
+
+    def encode(self, event: Event) -> Optional[bytes]:
+        if event.kind == "result":
+            return dumps(event.data)
+        if event.kind == "error":
+            return dumps({"error": event.data["message"]})
+        return None
+
+
+ENCODERS = {"sse": JsonSseEncoder, "htmx": HtmxSseEncoder, "ndjson": NdjsonEncoder}
+
+
+# ----------------------
+# Engine
+# ----------------------
+class PipelineContext:
+    def __init__(self, endpoint: str, encoder, account=None, usage=None, **inputs):
+        self.endpoint = endpoint
+        self.encoder = encoder
+        self.account = account
+        # UsageCounter passed to the stages' LLM calls
+        self.usage = usage
+        self.inputs = inputs
+        self.request_id = uuid.uuid4().hex[:12]
+        self.started = time.perf_counter()
+        # Filled in by the stages
+        self.student = None
+        self.profile = None
+        # Class requests: the canonical profiles, and the tenant usage is recorded under
+        self.students = None
+        self.tenant: Optional[str] = None
+        self.text_summary: Optional[str] = None
+        self.prompt: Optional[str] = None
+        self.analysis = None
+        self.rendered = False
+        self.timings: Dict[str, float] = {}
+        self.outcome: Optional[str] = None
+
+
+StageFn = Callable[[PipelineContext], Union[AsyncIterator[Union[Event, bytes]], Awaitable[None]]]
+
+
+class Pipeline:
+    def __init__(self, name: str, stages: Sequence[Tuple[str, StageFn]], hooks: Sequence[Any] = ()):
+        self.name = name
+        self.stages = list(stages)
+        self.hooks = list(hooks)
+
+    async def run(self, ctx: PipelineContext) -> AsyncIterator[bytes]:
+        outcome = "cancelled"
+        running = None
+        try:
+            for name, stage_fn in self.stages:
+                started = time.perf_counter()
+                with diagnostics.stage(name):
+                    stage = stage_fn(ctx)
+                    if inspect.isasyncgen(stage):
+                        running = stage
+                        async for item in running:
+                            frame = item if isinstance(item, bytes) else ctx.encoder.encode(item)
+                            if frame:
+                                yield frame
+                        running = None
+                    else:
+                        await stage
+                elapsed = time.perf_counter() - started
+                ctx.timings[name] = elapsed
+                for hook in self.hooks:
+                    hook.on_stage(self.name, name, elapsed)
+            outcome = "done"
+        except Exception as e:
+            outcome = "error"
+            if ctx.account:
+                ctx.account.mark_error()
+            yield ctx.encoder.encode(Event("error", {"message": str(e)}))
+        finally:
+            if running is not None:
+                # Client went away mid-stage: run the stage's cleanup now
+                await running.aclose()
+            ctx.outcome = outcome
+            for hook in self.hooks:
+                hook.on_finish(self.name, ctx, outcome)
+
+
+class StageTimings:
+    """Timing hook: per-pipeline stage duration percentiles and run outcomes."""
+
+    def __init__(self, samples: int = 1000):
+        self.samples = samples
+        self.durations: Dict[str, Dict[str, Deque[float]]] = {}
+        self.outcomes: Dict[str, Dict[str, int]] = {}
+
+    def on_stage(self, pipeline: str, stage: str, elapsed: float) -> None:
+        stages = self.durations.setdefault(pipeline, {})
+        stages.setdefault(stage, deque(maxlen=self.samples)).append(elapsed)
+
+    def on_finish(self, pipeline: str, ctx: PipelineContext, outcome: str) -> None:
+        outcomes = self.outcomes.setdefault(pipeline, {})
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    def summary(self) -> dict:
+        return {
+            pipeline: {
+                "outcomes": self.outcomes.get(pipeline, {}),
+                "stages_s": {stage: percentiles(samples) for stage, samples in stages.items()},
+            }
+            for pipeline, stages in self.durations.items()
+        }
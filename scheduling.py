@@ -0,0 +1,216 @@
+"""
+Weighted-fair scheduling of generation capacity across tenants.
+
+Every generation (an interactive stream, one packed class request, a
+speculation) takes a slot before it calls the LLM. When all slots are busy,
+requests wait in per-tenant queues and freed slots are handed out:
+
+1. by priority class, strictly: interactive, then bulk, then speculative;
+2. within a class, by start-time fair queuing across tenants, so each
+   tenant gets slots in proportion to its weight however much it queued;
+3. subject to a per-tenant token bucket, so one tenant cannot take more
+   than its configured rate even when the others are idle.
+
+A tenant is derived from the StudentInfo (the school by default). Tenants
+come from a free-text field, so a dispatch only looks at tenants with
+queued requests, and a tenant with nothing queued or running is forgotten
+after `idle_seconds` (by then its fair-queuing and token bucket state is
+the same as a new tenant's).
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Optional
+from models import StudentInfo
+from stats import percentiles
+
+PRIORITIES = ("interactive", "bulk", "speculative")
+
+
+def tenant_of(student: StudentInfo, key: str = "school") -> str:
+    """Tenant of a profile: the value of one StudentInfo field, case-insensitive."""
+    return str(getattr(student, key)).strip().lower() or "unknown"
+
+
+class _Waiter:
+    def __init__(self, tenant: str, priority: str):
+        self.tenant = tenant
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.rate_limited = False
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class _Tenant:
+    def __init__(self, weight: float, burst: float):
+        self.weight = weight
+        self.tokens = burst
+        self.refilled_at = time.monotonic()
+        # Virtual finish time of the tenant's last dispatched request
+        self.finish = 0.0
+        self.queues: Dict[str, Deque[_Waiter]] = {p: deque() for p in PRIORITIES}
+        self.in_flight = 0
+        self.dispatched = 0
+        self.rate_limited = 0
+        self.waits: Dict[str, Deque[float]] = {p: deque(maxlen=1000) for p in PRIORITIES}
+        self.service: Deque[float] = deque(maxlen=1000)
+
+
+class FairScheduler:
+    def __init__(self, capacity: int, rate: float = 0.0, burst: float = 1.0,
+                 weights: Optional[Dict[str, float]] = None, idle_seconds: float = 300.0):
+        """
+        capacity: generations running at once across all tenants
+        rate, burst: per-tenant token bucket (generations per second; 0 disables it)
+        weights: relative share per tenant (default 1)
+        idle_seconds: forget a tenant (and its stats) after this long with no work
+        """
+        self.capacity = capacity
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.weights = {tenant.lower(): weight for tenant, weight in (weights or {}).items()}
+        # Never shorter than a full token bucket refill, so pruning cannot reset a limited tenant
+        self.idle_seconds = max(idle_seconds, self.burst / rate if rate > 0 else 0.0)
+        self.tenants: Dict[str, _Tenant] = {}
+        # Tenants with queued requests, per priority (the only ones a dispatch looks at)
+        self.queued: Dict[str, Dict[str, _Tenant]] = {p: {} for p in PRIORITIES}
+        # Tenants with nothing queued or running, oldest first, with the time they went idle
+        self._idle: "OrderedDict[str, float]" = OrderedDict()
+        self.in_use = 0
+        self.virtual_time = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @asynccontextmanager
+    async def slot(self, tenant: str, priority: str = "interactive"):
+        """Hold one generation slot for the duration of the block."""
+        await self.acquire(tenant, priority)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.tenants[tenant].service.append(time.monotonic() - started)
+            self.release(tenant)
+
+    async def acquire(self, tenant: str, priority: str = "interactive") -> None:
+        self._prune(time.monotonic())
+        state = self._tenant(tenant)
+        waiter = _Waiter(tenant, priority)
+        state.queues[priority].append(waiter)
+        self.queued[priority][tenant] = state
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Granted, but the caller went away before using the slot
+                self.release(tenant)
+            else:
+                state.queues[priority].remove(waiter)
+                if not state.queues[priority]:
+                    del self.queued[priority][tenant]
+                self._settle(tenant, state)
+            raise
+
+    def release(self, tenant: str) -> None:
+        state = self.tenants[tenant]
+        self.in_use -= 1
+        state.in_flight -= 1
+        self._settle(tenant, state)
+        self._dispatch()
+
+    def _tenant(self, tenant: str) -> _Tenant:
+        state = self.tenants.get(tenant)
+        if state is None:
+            state = self.tenants[tenant] = _Tenant(self.weights.get(tenant, 1.0), self.burst)
+        self._idle.pop(tenant, None)
+        return state
+
+    def _settle(self, tenant: str, state: _Tenant) -> None:
+        # A tenant with nothing queued or running starts its idle time
+        if not state.in_flight and not any(state.queues.values()):
+            self._idle[tenant] = time.monotonic()
+            self._idle.move_to_end(tenant)
+
+    def _prune(self, now: float) -> None:
+        while self._idle:
+            tenant, idle_since = next(iter(self._idle.items()))
+            if now - idle_since < self.idle_seconds:
+                break
+            del self._idle[tenant]
+            del self.tenants[tenant]
+
+    def _refill(self, state: _Tenant, now: float) -> None:
+        if self.rate > 0:
+            state.tokens = min(self.burst, state.tokens + (now - state.refilled_at) * self.rate)
+        state.refilled_at = now
+
+    def _dispatch(self) -> None:
+        now = time.monotonic()
+        next_refill: Optional[float] = None
+
+        while self.in_use < self.capacity:
+            chosen: Optional[_Tenant] = None
+            chosen_start = 0.0
+            for priority in PRIORITIES:
+                for state in self.queued[priority].values():
+                    self._refill(state, now)
+                    if self.rate > 0 and state.tokens < 1:
+                        head = state.queues[priority][0]
+                        if not head.rate_limited:
+                            head.rate_limited = True
+                            state.rate_limited += 1
+                        wait = (1 - state.tokens) / self.rate
+                        next_refill = wait if next_refill is None else min(next_refill, wait)
+                        continue
+                    start = max(self.virtual_time, state.finish)
+                    if chosen is None or start < chosen_start:
+                        chosen, chosen_start = state, start
+                if chosen is not None:
+                    break
+            if chosen is None:
+                break
+
+            waiter = chosen.queues[priority].popleft()
+            if not chosen.queues[priority]:
+                del self.queued[priority][waiter.tenant]
+            if self.rate > 0:
+                chosen.tokens -= 1
+            self.virtual_time = chosen_start
+            chosen.finish = chosen_start + 1.0 / chosen.weight
+            chosen.in_flight += 1
+            chosen.dispatched += 1
+            chosen.waits[priority].append(now - waiter.enqueued_at)
+            self.in_use += 1
+            waiter.future.set_result(None)
+            next_refill = None
+
+        if next_refill is not None:
+            # Only rate-limited tenants are waiting; look again once a token is back
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = asyncio.get_running_loop().call_later(next_refill, self._dispatch)
+
+    def summary(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "in_use": self.in_use,
+            "queued": {p: sum(len(s.queues[p]) for s in self.queued[p].values()) for p in PRIORITIES},
+            "idle_tenants": len(self._idle),
+            "wait_s": {
+                p: percentiles([w for s in self.tenants.values() for w in s.waits[p]])
+                for p in PRIORITIES
+            },
+            "tenants": {
+                tenant: {
+                    "weight": state.weight,
+                    "queued": {p: len(state.queues[p]) for p in PRIORITIES if state.queues[p]},
+                    "in_flight": state.in_flight,
+                    "dispatched": state.dispatched,
+                    "rate_limited": state.rate_limited,
+                    "wait_s": {p: percentiles(state.waits[p]) for p in PRIORITIES if state.waits[p]},
+                    "service_s": percentiles(state.service),
+                }
+                for tenant, state in self.tenants.items()
+            },
+        }
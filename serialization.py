@@ -0,0 +1,82 @@
+import orjson
+from typing import Any
+from pydantic import BaseModel
+
+# ----------------------
+# JSON encoding
+# ----------------------
+def _default(obj: Any) -> Any:
+    # Let Pydantic's compiled serializer produce the JSON and embed it as-is
+    if isinstance(obj, BaseModel):
+        return orjson.Fragment(obj.__pydantic_serializer__.to_json(obj))
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(obj: Any) -> bytes:
+    """Encode obj (including nested Pydantic models) to compact JSON bytes."""
+    return orjson.dumps(obj, default=_default)
+
+
+# ----------------------
+# SSE frames
+# ----------------------
+def sse_data(payload: Any) -> bytes:
+    """Unnamed SSE frame carrying a JSON payload (used by /persona/stream/)."""
+    return b"data: " + dumps(payload) + b"\n\n"
+
+
+def sse_event(event: str, data: str) -> bytes:
+    """Named SSE frame (used by /persona/stream-htmx). Multi-line data is split into data lines."""
+    if "\n" in data:
+        data = data.replace("\n", "\ndata: ")
+    # Single encode of the whole frame; large HTML payloads are not copied twice
+    return f"event: {event}\ndata: {data}\n\n".encode("utf-8")
+
+
+def sse_script(script: str, event: str = "stage") -> bytes:
+    """Named SSE frame carrying a script for htmx to execute on swap."""
+    return sse_event(event, f"<script>{script}</script>")
+
+
+_TOKEN_PREFIX = b'data: {"type":"token","content":'
+_WORD_COUNT = b',"word_count":'
+_TOKEN_SUFFIX = b"}\n\n"
+
+
+def sse_token(token: str, word_count: int) -> bytes:
+    """Hot path: one frame per LLM token, assembled without building a dict."""
+    return _TOKEN_PREFIX + orjson.dumps(token) + _WORD_COUNT + str(word_count).encode("ascii") + _TOKEN_SUFFIX
+
+
+# ----------------------
+# Constant frames
+# ----------------------
+# JSON stream (/persona/stream/)
+STAGE_PROCESSING = sse_data({
+    'type': 'stage',
+    'stage': 'processing',
+    'message': 'Processing student information...'
+})
+STAGE_THINKING = sse_data({
+    'type': 'stage',
+    'stage': 'thinking',
+    'message': 'AI is analyzing your profile...'
+})
+STAGE_STREAMING = sse_data({
+    'type': 'stage',
+    'stage': 'streaming',
+    'message': 'Generating persona...'
+})
+
+# HTMX stream (/persona/stream-htmx)
+HTMX_STAGE_GENERATING = sse_script(
+    "document.getElementById('step-thinking').classList.remove('active'); "
+    "document.getElementById('step-thinking').classList.add('completed'); "
+    "document.getElementById('step-generating').classList.add('active'); "
+    "var summaryBox = document.getElementById('studentSummaryBox'); "
+    "if(summaryBox) summaryBox.style.display = 'none';"
+)
+HTMX_DONE = sse_event("done", '<div id="sse-connection-closed"></div>')
+
+# Both SSE streams: a comment line, ignored by EventSource and the htmx sse extension
+SSE_HEARTBEAT = b": keepalive\n\n"
@@ -0,0 +1,144 @@
+import json
+import os
+from dotenv import load_dotenv
+
+# ----------------------
+# Load environment variables
+# ----------------------
+# Loaded here as well as in main.py so that settings read at import time
+# see the values from .env
+load_dotenv()
+
+# ----------------------
+# Profile handoff (htmx-setup -> stream-htmx)
+# ----------------------
+# How long a validated profile waits for its SSE connection (seconds)
+HANDOFF_TTL_SECONDS = float(os.getenv("HANDOFF_TTL_SECONDS", "300"))
+# Upper bound on stored profiles; the oldest are evicted first
+HANDOFF_MAX_ENTRIES = int(os.getenv("HANDOFF_MAX_ENTRIES", "10000"))
+
+# ----------------------
+# Admin endpoints
+# ----------------------
+# Admin endpoints are disabled unless a token is configured; requests must
+# send it in the X-Admin-Token header
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") or None
+
+# ----------------------
+# Diagnostics (event-loop lag and request profiling)
+# ----------------------
+DIAGNOSTICS_ENABLED = os.getenv("DIAGNOSTICS_ENABLED", "false").lower() in ("1", "true", "yes")
+# How often the event loop is sampled for lag (seconds)
+DIAGNOSTICS_LAG_INTERVAL = float(os.getenv("DIAGNOSTICS_LAG_INTERVAL", "0.05"))
+# Lag above this is recorded as a stall, with the blocking stack (seconds)
+DIAGNOSTICS_STALL_THRESHOLD = float(os.getenv("DIAGNOSTICS_STALL_THRESHOLD", "0.1"))
+# Sampling period of the per-request profiler (seconds)
+DIAGNOSTICS_PROFILE_INTERVAL = float(os.getenv("DIAGNOSTICS_PROFILE_INTERVAL", "0.001"))
+
+# ----------------------
+# Class (batch) generation
+# ----------------------
+# Output token budget for one packed request; pack sizes are chosen to fit it
+BATCH_MAX_OUTPUT_TOKENS = int(os.getenv("BATCH_MAX_OUTPUT_TOKENS", "32000"))
+# Never pack more students than this into one request
+BATCH_MAX_PACK_SIZE = int(os.getenv("BATCH_MAX_PACK_SIZE", "8"))
+# Starting estimate of output tokens per student, refined from observed usage
+BATCH_INITIAL_TOKENS_PER_STUDENT = int(os.getenv("BATCH_INITIAL_TOKENS_PER_STUDENT", "2500"))
+# Packed requests (and individual fallbacks) running at once per class request
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+# ----------------------
+# Persona generation mode (/persona/stream-htmx)
+# ----------------------
+# "single": one structured call; "fanout": the persona and each learning
+# method are generated by concurrent smaller calls and streamed card by card
+PERSONA_GENERATION_MODE = os.getenv("PERSONA_GENERATION_MODE", "single")
+# Fan-out calls in flight per request
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "7"))
+
+# ----------------------
+# Speculative generation (/persona/prefetch)
+# ----------------------
+# Off by default: speculations the user never submits still cost tokens
+SPECULATION_ENABLED = os.getenv("SPECULATION_ENABLED", "false").lower() in ("1", "true", "yes")
+# How long a speculated result waits for a matching submit (seconds)
+SPECULATION_TTL_SECONDS = float(os.getenv("SPECULATION_TTL_SECONDS", "120"))
+# Upper bound on pending speculations; the oldest are discarded first
+SPECULATION_MAX_ENTRIES = int(os.getenv("SPECULATION_MAX_ENTRIES", "1000"))
+
+# ----------------------
+# Fair scheduling of generation capacity across tenants
+# ----------------------
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "false").lower() in ("1", "true", "yes")
+# Generations (streams, class packs, speculations) running at once across all tenants
+SCHEDULER_CAPACITY = int(os.getenv("SCHEDULER_CAPACITY", "16"))
+# StudentInfo field that identifies the tenant
+SCHEDULER_TENANT_KEY = os.getenv("SCHEDULER_TENANT_KEY", "school")
+# Per-tenant token bucket: generations per second (0 disables the limit) and burst size
+SCHEDULER_TENANT_RATE = float(os.getenv("SCHEDULER_TENANT_RATE", "0"))
+SCHEDULER_TENANT_BURST = float(os.getenv("SCHEDULER_TENANT_BURST", "5"))
+# Relative shares as JSON, e.g. {"smk taman connaught": 2}; unlisted tenants have weight 1
+SCHEDULER_TENANT_WEIGHTS = json.loads(os.getenv("SCHEDULER_TENANT_WEIGHTS", "{}"))
+# Forget a tenant (and its stats) after this many seconds with nothing queued or running
+SCHEDULER_TENANT_IDLE_SECONDS = float(os.getenv("SCHEDULER_TENANT_IDLE_SECONDS", "300"))
+
+# ----------------------
+# LLM backend
+# ----------------------
+# "openai" (live), "record" (live, and every call is saved to LLM_RECORD_PATH)
+# or "replay" (answers from LLM_RECORD_PATH without calling OpenAI)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+LLM_RECORD_PATH = os.getenv("LLM_RECORD_PATH", "recordings/llm.jsonl")
+# Replay timing relative to the recording: 1 = original, 0.5 = twice as fast, 0 = instant
+LLM_REPLAY_TIME_SCALE = float(os.getenv("LLM_REPLAY_TIME_SCALE", "1"))
+# Fail prompts with no exact recording instead of reusing one of the same shape
+LLM_REPLAY_STRICT = os.getenv("LLM_REPLAY_STRICT", "false").lower() in ("1", "true", "yes")
+
+# ----------------------
+# Circuit breaker and adaptive timeouts (LLM calls in the streaming endpoints)
+# ----------------------
+BREAKER_ENABLED = os.getenv("BREAKER_ENABLED", "false").lower() in ("1", "true", "yes")
+# The circuit opens when this share of the last BREAKER_WINDOW calls failed
+# (once at least BREAKER_MIN_CALLS have been made)
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+BREAKER_FAILURE_RATIO = float(os.getenv("BREAKER_FAILURE_RATIO", "0.5"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+# How long an open circuit rejects calls before letting a probe through (seconds)
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+# Call timeout = this percentile of recent successful durations x multiplier,
+# clamped to [min, max]; the max is used until enough calls have been seen
+BREAKER_TIMEOUT_PERCENTILE = float(os.getenv("BREAKER_TIMEOUT_PERCENTILE", "0.99"))
+BREAKER_TIMEOUT_MULTIPLIER = float(os.getenv("BREAKER_TIMEOUT_MULTIPLIER", "2"))
+BREAKER_MIN_TIMEOUT = float(os.getenv("BREAKER_MIN_TIMEOUT", "10"))
+BREAKER_MAX_TIMEOUT = float(os.getenv("BREAKER_MAX_TIMEOUT", "120"))
+# Recent results kept per profile to serve while the circuit is open
+BREAKER_FALLBACK_ENTRIES = int(os.getenv("BREAKER_FALLBACK_ENTRIES", "1000"))
+
+# ----------------------
+# Usage accounting
+# ----------------------
+# USD per million tokens by model name prefix, as JSON; calls to unlisted models are counted but not priced
+USAGE_PRICES = json.loads(os.getenv(
+    "USAGE_PRICES",
+    '{"gpt-5-nano": {"input": 0.05, "cached_input": 0.005, "output": 0.40}}'
+))
+# Most expensive recent requests listed by /admin/usage
+USAGE_TOP_REQUESTS = int(os.getenv("USAGE_TOP_REQUESTS", "20"))
+# Tenants with their own totals in /admin/usage; the least recently active are merged into one entry
+USAGE_MAX_TENANTS = int(os.getenv("USAGE_MAX_TENANTS", "1000"))
+
+# ----------------------
+# Draining (graceful shutdown)
+# ----------------------
+# How long in-flight streams may keep running after SIGTERM before they are
+# cut off with a retry event (keep it below the orchestrator's kill timeout)
+DRAIN_GRACE_SECONDS = float(os.getenv("DRAIN_GRACE_SECONDS", "25"))
+# Retry-After sent with generations refused while draining (seconds)
+DRAIN_RETRY_AFTER_SECONDS = int(os.getenv("DRAIN_RETRY_AFTER_SECONDS", "5"))
+
+# ----------------------
+# SSE heartbeats
+# ----------------------
+# A stream that has sent nothing for this long gets a keepalive comment, so
+# proxies with idle timeouts keep it open (seconds; 0 disables heartbeats)
+HEARTBEAT_INTERVAL_SECONDS = float(os.getenv("HEARTBEAT_INTERVAL_SECONDS", "15"))
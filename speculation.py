@@ -0,0 +1,157 @@
+"""
+Speculative persona generation.
+
+While the user is still filling the form, the page sends the current field
+values to /persona/prefetch (debounced). Once they form a valid profile,
+generation starts in the background and its result is kept, keyed by the
+canonical StudentInfo, for a short window. A submit with the same profile
+claims it instead of calling the model again; an edit replaces the form
+session's speculation and cancels the stale one.
+
+Every speculation records the tokens it consumed (estimated from streamed
+tokens until the provider reports usage), so tokens spent on speculations
+that were never claimed are reported as wasted next to the hit rate.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+from langchain_core.callbacks import AsyncCallbackHandler
+from models import StudentInfo, PersonaAnalysis
+from utils import profile_key
+from usage import UsageCounter
+
+
+class Speculation:
+    def __init__(self, key: str, task: asyncio.Task, counter: UsageCounter, expires_at: float):
+        self.key = key
+        self.task = task
+        self.counter = counter
+        self.expires_at = expires_at
+        self.sessions: Set[str] = set()
+
+    async def result(self) -> Optional[PersonaAnalysis]:
+        """The speculated analysis, or None if the generation failed or was cancelled."""
+        try:
+            # Shielded: a claiming stream that disconnects does not cancel the generation
+            return await asyncio.shield(self.task)
+        except asyncio.CancelledError:
+            if self.task.cancelled():
+                return None
+            raise
+        except Exception:
+            return None
+
+
+Generate = Callable[[StudentInfo, List[AsyncCallbackHandler]], Awaitable[PersonaAnalysis]]
+
+
+class SpeculationCache:
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Speculation]" = OrderedDict()
+        # Form session -> key of the profile it is currently speculating on
+        self._sessions: Dict[str, str] = {}
+        self.stats = {
+            "started": 0,
+            "reused": 0,
+            "hits": 0,
+            "hits_in_flight": 0,
+            "misses": 0,
+            "cancelled": 0,
+            "expired": 0,
+            "tokens_used": 0,
+            "tokens_wasted": 0,
+        }
+
+    def speculate(self, session: str, student: StudentInfo, generate: Generate) -> Speculation:
+        """Make `student` the session's speculation, starting generation if needed."""
+        now = time.monotonic()
+        self._evict(now)
+
+        key = profile_key(student)
+        previous = self._sessions.get(session)
+        if previous is not None and previous != key:
+            self.forget(session)
+
+        speculation = self._entries.get(key)
+        if speculation is None:
+            counter = UsageCounter()
+            task = asyncio.create_task(generate(student, [counter]))
+            speculation = Speculation(key, task, counter, now + self.ttl_seconds)
+            self._entries[key] = speculation
+            self.stats["started"] += 1
+        elif session not in speculation.sessions:
+            # Another session (or tab) already speculated on the same profile
+            self.stats["reused"] += 1
+
+        speculation.sessions.add(session)
+        self._sessions[session] = key
+        return speculation
+
+    def forget(self, session: str) -> None:
+        """The session's profile changed: drop its speculation unless another session shares it."""
+        key = self._sessions.pop(session, None)
+        speculation = self._entries.get(key) if key else None
+        if speculation is None:
+            return
+        speculation.sessions.discard(session)
+        if not speculation.sessions:
+            self._discard(speculation, "cancelled")
+
+    def claim(self, student: StudentInfo) -> Optional[Speculation]:
+        """Take the speculation for a submitted profile, if there is one."""
+        self._evict(time.monotonic())
+
+        speculation = self._entries.pop(profile_key(student), None)
+        if speculation is None:
+            self.stats["misses"] += 1
+            return None
+
+        for session in speculation.sessions:
+            self._sessions.pop(session, None)
+        self.stats["hits"] += 1
+        if not speculation.task.done():
+            self.stats["hits_in_flight"] += 1
+        speculation.task.add_done_callback(
+            lambda _: self._count_tokens("tokens_used", speculation)
+        )
+        return speculation
+
+    def summary(self) -> dict:
+        claims = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": round(self.stats["hits"] / claims, 3) if claims else None,
+            # Share of started speculations that a submit actually used
+            "use_rate": round(self.stats["hits"] / self.stats["started"], 3) if self.stats["started"] else None,
+            "pending": len(self._entries),
+            "in_flight": sum(1 for s in self._entries.values() if not s.task.done()),
+        }
+
+    def _discard(self, speculation: Speculation, reason: str) -> None:
+        self._entries.pop(speculation.key, None)
+        for session in speculation.sessions:
+            if self._sessions.get(session) == speculation.key:
+                del self._sessions[session]
+        self.stats[reason] += 1
+        if speculation.task.done():
+            self._count_tokens("tokens_wasted", speculation)
+        else:
+            speculation.task.add_done_callback(
+                lambda _: self._count_tokens("tokens_wasted", speculation)
+            )
+            speculation.task.cancel()
+
+    def _count_tokens(self, stat: str, speculation: Speculation) -> None:
+        self.stats[stat] += speculation.counter.total
+
+    def _evict(self, now: float) -> None:
+        # All entries share one TTL, so the oldest are at the front; entries
+        # pushed out by max_entries are counted as expired too
+        while self._entries:
+            speculation = next(iter(self._entries.values()))
+            if speculation.expires_at > now and len(self._entries) < self.max_entries:
+                break
+            self._discard(speculation, "expired")
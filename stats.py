@@ -0,0 +1,26 @@
+"""
+Percentiles for the latency and duration samples reported by the admin
+endpoints, the circuit breaker's adaptive timeout and the benchmarks.
+"""
+from typing import Iterable, Optional, Sequence
+
+
+def percentile(ordered: Sequence[float], q: float) -> float:
+    """Nearest-rank `q` quantile of already sorted samples (0.0 when there are none)."""
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)] if ordered else 0.0
+
+
+def percentiles(samples: Iterable[float], quantiles: Sequence[float] = (0.50, 0.95),
+                digits: Optional[int] = 4) -> dict:
+    """Sample count, the given quantiles (as "p50", "p95", ...) and the max."""
+    ordered = sorted(samples)
+
+    def pick(q: float) -> float:
+        value = percentile(ordered, q)
+        return round(value, digits) if digits is not None else value
+
+    return {
+        "count": len(ordered),
+        **{f"p{round(q * 100)}": pick(q) for q in quantiles},
+        "max": pick(1.0),
+    }
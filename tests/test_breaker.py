@@ -0,0 +1,172 @@
+import asyncio
+from collections import deque
+import pytest
+import breaker
+from breaker import CircuitBreaker, CircuitOpenError
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(breaker.time, "monotonic", lambda: now[0])
+    return now
+
+
+def make_breaker(**overrides) -> CircuitBreaker:
+    options = dict(window=10, failure_ratio=0.5, min_calls=4, open_seconds=30,
+                   timeout_percentile=0.95, timeout_multiplier=2.0,
+                   min_timeout=5.0, max_timeout=60.0, min_samples=5)
+    options.update(overrides)
+    return CircuitBreaker(**options)
+
+
+async def call(cb: CircuitBreaker, fail: bool = False) -> None:
+    async with cb.guard("text"):
+        if fail:
+            raise RuntimeError("provider error")
+
+
+async def failing(cb: CircuitBreaker) -> None:
+    with pytest.raises(RuntimeError):
+        await call(cb, fail=True)
+
+
+def open_breaker(cb: CircuitBreaker) -> None:
+    async def run():
+        for _ in range(cb.min_calls):
+            await failing(cb)
+
+    asyncio.run(run())
+    assert cb.state == "open"
+
+
+def test_stays_closed_below_min_calls():
+    cb = make_breaker()
+
+    async def run():
+        for _ in range(3):
+            await failing(cb)
+
+    asyncio.run(run())
+    assert cb.state == "closed"
+
+
+def test_opens_at_failure_ratio():
+    cb = make_breaker()
+
+    async def run():
+        await call(cb)
+        await call(cb)
+        await failing(cb)
+        assert cb.state == "closed"
+        # 2 failures out of 4 calls reaches the 0.5 ratio
+        await failing(cb)
+
+    asyncio.run(run())
+    assert cb.state == "open"
+
+
+def test_fails_fast_while_open(clock):
+    cb = make_breaker()
+    open_breaker(cb)
+    ran = []
+
+    async def run():
+        async with cb.guard("text"):
+            ran.append(True)
+
+    clock[0] += 10
+    with pytest.raises(CircuitOpenError) as excinfo:
+        asyncio.run(run())
+    assert ran == []
+    assert excinfo.value.retry_after == pytest.approx(20)
+    assert cb.counts["rejected"] == 1
+
+
+def test_half_open_lets_one_probe_through(clock):
+    cb = make_breaker()
+    open_breaker(cb)
+    clock[0] += 30
+    rejected = []
+
+    async def run():
+        probe_started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def probe():
+            async with cb.guard("text"):
+                probe_started.set()
+                await release.wait()
+
+        task = asyncio.create_task(probe())
+        await probe_started.wait()
+        assert cb.state == "half_open"
+        try:
+            await call(cb)
+        except CircuitOpenError:
+            rejected.append(True)
+        release.set()
+        await task
+
+    asyncio.run(run())
+    assert rejected == [True]
+    assert cb.state == "closed"
+
+
+def test_failed_probe_opens_again(clock):
+    cb = make_breaker()
+    open_breaker(cb)
+    clock[0] += 30
+    asyncio.run(failing(cb))
+    assert cb.state == "open"
+    assert cb.changed_at == clock[0]
+
+
+def test_cancelled_probe_leaves_state_unchanged(clock):
+    cb = make_breaker()
+    open_breaker(cb)
+    clock[0] += 30
+    counts = dict(cb.counts)
+
+    async def run():
+        probe_started = asyncio.Event()
+
+        async def probe():
+            async with cb.guard("text"):
+                probe_started.set()
+                await asyncio.Event().wait()
+
+        task = asyncio.create_task(probe())
+        await probe_started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert cb.state == "half_open"
+    assert cb.counts == counts
+    assert not cb._probing
+    # The next call is let through as the probe
+    asyncio.run(call(cb))
+    assert cb.state == "closed"
+
+
+def test_timeout_is_max_before_min_samples():
+    cb = make_breaker()
+    assert cb.timeout("text") == 60.0
+    cb.durations["text"] = deque([1.0] * 4)
+    assert cb.timeout("text") == 60.0
+
+
+def test_timeout_follows_durations_after_min_samples():
+    cb = make_breaker()
+    cb.durations["text"] = deque([3.0] * 5)
+    assert cb.timeout("text") == pytest.approx(6.0)
+
+
+def test_timeout_is_clamped_after_min_samples():
+    cb = make_breaker()
+    cb.durations["text"] = deque([0.5] * 5)
+    assert cb.timeout("text") == 5.0
+    cb.durations["text"] = deque([45.0] * 5)
+    assert cb.timeout("text") == 60.0
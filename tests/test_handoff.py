@@ -0,0 +1,71 @@
+import pytest
+import handoff
+from handoff import HandoffStore
+from models import StudentInfo
+
+STUDENT = StudentInfo(
+    name="Nur Aisyah", gender="female", form="Form 4", school="SMK Taman Connaught",
+    preferred_language="Malay", favourite_subjects=["Biology"], study_frequency="daily",
+)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(handoff.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_round_trip_and_reuse():
+    store = HandoffStore(ttl_seconds=60, max_entries=10)
+    ticket = store.put(STUDENT)
+    assert store.get(ticket) == STUDENT
+    # EventSource reconnects reuse the ticket
+    assert store.get(ticket) == STUDENT
+
+
+def test_ticket_is_short_and_opaque():
+    ticket = HandoffStore(60, 10).put(STUDENT)
+    assert len(ticket) <= 32
+    assert "Aisyah" not in ticket and "SMK" not in ticket
+
+
+def test_tampered_ticket_is_rejected():
+    store = HandoffStore(60, 10)
+    ticket = store.put(STUDENT)
+    tampered = ticket[:-1] + ("A" if ticket[-1] != "A" else "B")
+    assert store.get(tampered) is None
+
+
+def test_expired_ticket_is_rejected(clock):
+    store = HandoffStore(ttl_seconds=60, max_entries=10)
+    ticket = store.put(STUDENT)
+    clock[0] += 59
+    assert store.get(ticket) == STUDENT
+    clock[0] += 1
+    assert store.get(ticket) is None
+    assert len(store) == 0
+
+
+@pytest.mark.parametrize("ticket", ["", "not-a-ticket", "x" * 10_000, "../../etc/passwd", "é"])
+def test_malformed_ticket_is_rejected(ticket):
+    store = HandoffStore(60, 10)
+    store.put(STUDENT)
+    assert store.get(ticket) is None
+
+
+def test_oldest_entries_are_evicted_at_capacity():
+    store = HandoffStore(ttl_seconds=60, max_entries=3)
+    tickets = [store.put(STUDENT) for _ in range(4)]
+    assert len(store) == 3
+    assert store.get(tickets[0]) is None
+    assert all(store.get(t) == STUDENT for t in tickets[1:])
+
+
+def test_expired_entries_are_evicted_on_put(clock):
+    store = HandoffStore(ttl_seconds=60, max_entries=10)
+    store.put(STUDENT)
+    store.put(STUDENT)
+    clock[0] += 61
+    store.put(STUDENT)
+    assert len(store) == 1
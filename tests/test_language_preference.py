@@ -0,0 +1,37 @@
+import pytest
+from models import StudentInfo
+from utils import infer_language_preference, is_smk
+
+
+def student(name: str, school: str, preferred_language: str) -> StudentInfo:
+    return StudentInfo(
+        name=name, gender="female", form="Form 4", school=school,
+        preferred_language=preferred_language, favourite_subjects=["Biology"], study_frequency="daily",
+    )
+
+
+@pytest.mark.parametrize("school", [
+    "SMK Taman Connaught", "S.M.K. Bangsar", "SMK(P) Sri Aman", "SMKA Kuala Lumpur",
+    "Sekolah Menengah Kebangsaan Bangsar", "sekolah  menengah kebangsaan, bangsar",
+])
+def test_smk_spellings(school):
+    assert is_smk(school)
+
+
+@pytest.mark.parametrize("school", ["Sri KDU", "Chong Hwa Independent High School", "SJK(C) Kuen Cheng"])
+def test_other_schools(school):
+    assert not is_smk(school)
+
+
+def test_malay_name_in_smk_is_malay():
+    assert infer_language_preference(student("Nur Aisyah binti Ahmad", "SMK(P) Sri Aman", "English")) == "Malay"
+
+
+def test_otherwise_malay_is_not_the_primary_language():
+    # The rule does not fire, so a stated Malay preference becomes English
+    assert infer_language_preference(student("Priya", "SMK Bangsar", "Malay")) == "English"
+    assert infer_language_preference(student("Nur Aisyah", "Sri KDU", "Malay")) == "English"
+
+
+def test_otherwise_stated_preference_is_kept():
+    assert infer_language_preference(student("Priya", "SMK Bangsar", "Mandarin")) == "Mandarin"
@@ -0,0 +1,60 @@
+import asyncio
+import pytest
+from scheduling import FairScheduler
+
+
+def test_cancelled_after_grant_gives_the_slot_back():
+    async def run():
+        scheduler = FairScheduler(capacity=1)
+        await scheduler.acquire("a")
+
+        granted = asyncio.create_task(scheduler.acquire("b"))
+        waiting = asyncio.create_task(scheduler.acquire("c"))
+        await asyncio.sleep(0)
+        assert scheduler.in_use == 1
+
+        # b is granted the slot but cancelled before it gets to run
+        scheduler.release("a")
+        assert granted.done() is False and scheduler.in_use == 1
+        granted.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await granted
+
+        # The slot went on to the next waiter rather than leaking
+        await asyncio.wait_for(waiting, 1)
+        assert scheduler.in_use == 1
+        assert scheduler.tenants["b"].in_flight == 0
+        scheduler.release("c")
+        assert scheduler.in_use == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_while_queued_leaves_no_trace():
+    async def run():
+        scheduler = FairScheduler(capacity=1)
+        await scheduler.acquire("a")
+
+        queued = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        queued.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+
+        assert scheduler.queued["interactive"] == {}
+        scheduler.release("a")
+        assert scheduler.in_use == 0
+        assert scheduler.tenants["b"].dispatched == 0
+
+    asyncio.run(run())
+
+
+def test_slot_is_released_when_the_block_ends():
+    async def run():
+        scheduler = FairScheduler(capacity=1)
+        async with scheduler.slot("a"):
+            assert scheduler.in_use == 1
+        assert scheduler.in_use == 0
+        assert scheduler.tenants["a"].in_flight == 0
+
+    asyncio.run(run())
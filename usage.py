@@ -0,0 +1,277 @@
+"""
+Token usage and cost accounting.
+
+A UsageCounter is passed as a LangChain callback to every LLM call made for
+one request. It records input, cached input and output tokens and the model
+of each call, from the provider's reported usage when there is one and from
+an estimate otherwise (calls cancelled part way never get a report).
+
+Pricing turns a call's tokens into dollars, and UsageLedger keeps rolling
+per-endpoint and per-tenant totals, how request latency tracks output tokens,
+and the most expensive recent requests. Tenants come from a free-text field,
+so only the most recently active ones keep their own totals; the rest are
+merged into one. The ledger is a pipeline hook, so
+every streamed request is recorded when it finishes, however it finishes.
+"""
+import heapq
+import itertools
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from uuid import UUID
+from langchain_core.callbacks import AsyncCallbackHandler
+from scheduling import tenant_of
+
+
+class Pricing:
+    """USD per million tokens by model; a model matches its longest listed prefix."""
+
+    def __init__(self, prices: Dict[str, Dict[str, float]]):
+        # {"gpt-5-nano": {"input": 0.05, "cached_input": 0.005, "output": 0.40}}
+        self.prices = prices
+
+    def rates(self, model: Optional[str]) -> Optional[Dict[str, float]]:
+        if not model:
+            return None
+        matches = [name for name in self.prices if model.startswith(name)]
+        return self.prices[max(matches, key=len)] if matches else None
+
+    def cost(self, model: Optional[str], input_tokens: int, cached_tokens: int,
+             output_tokens: int) -> Optional[float]:
+        rates = self.rates(model)
+        if rates is None:
+            return None
+        cached_rate = rates.get("cached_input", rates["input"])
+        return (
+            (input_tokens - cached_tokens) * rates["input"]
+            + cached_tokens * cached_rate
+            + output_tokens * rates["output"]
+        ) / 1_000_000
+
+
+class UsageCounter(AsyncCallbackHandler):
+    """Tokens used by the LLM calls of one request, including calls cancelled part way."""
+
+    def __init__(self, pricing: Optional[Pricing] = None):
+        self.pricing = pricing
+        self.calls: Dict[Any, Dict[str, Any]] = {}
+
+    async def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs):
+        # Rough 4-characters-per-token estimate, replaced by reported usage
+        chars = sum(len(str(message.content)) for batch in messages for message in batch)
+        params = kwargs.get("invocation_params") or {}
+        self.calls[run_id] = {
+            "model": params.get("model_name") or params.get("model")
+            or (kwargs.get("metadata") or {}).get("ls_model_name"),
+            "input_tokens": max(chars // 4, 1),
+            "cached_tokens": 0,
+            "output_tokens": 0,
+            "reported": False,
+        }
+
+    async def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs):
+        call = self.calls.get(run_id)
+        if call is not None and token:
+            call["output_tokens"] += 1
+
+    async def on_llm_end(self, response, *, run_id: UUID, **kwargs):
+        call = self.calls.get(run_id)
+        if call is None:
+            return
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None)
+                if usage:
+                    call["input_tokens"] = usage.get("input_tokens", call["input_tokens"])
+                    call["output_tokens"] = usage.get("output_tokens", call["output_tokens"])
+                    call["cached_tokens"] = (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+                    call["reported"] = True
+                model = (getattr(message, "response_metadata", None) or {}).get("model_name")
+                if model:
+                    call["model"] = model
+
+    def absorb(self, other: "UsageCounter") -> None:
+        """Count another counter's calls as this request's (a claimed speculation)."""
+        self.calls.update(other.calls)
+
+    @property
+    def prompt_tokens(self) -> int:
+        return sum(call["input_tokens"] for call in self.calls.values())
+
+    @property
+    def output_tokens(self) -> int:
+        return sum(call["output_tokens"] for call in self.calls.values())
+
+    @property
+    def total(self) -> int:
+        return self.prompt_tokens + self.output_tokens
+
+    def summary(self) -> dict:
+        calls = list(self.calls.values())
+        costs = [
+            self.pricing.cost(c["model"], c["input_tokens"], c["cached_tokens"], c["output_tokens"])
+            if self.pricing else None
+            for c in calls
+        ]
+        return {
+            "calls": len(calls),
+            "input_tokens": self.prompt_tokens,
+            "cached_tokens": sum(c["cached_tokens"] for c in calls),
+            "output_tokens": self.output_tokens,
+            "models": sorted({c["model"] for c in calls if c["model"]}),
+            # Priced calls only; unknown models are left out
+            "cost_usd": round(sum(cost for cost in costs if cost is not None), 8),
+            # True when some call had no reported usage (cancelled, or not reported)
+            "estimated": any(not c["reported"] for c in calls),
+        }
+
+
+class _Totals:
+    def __init__(self):
+        self.requests = 0
+        self.calls = 0
+        self.input_tokens = 0
+        self.cached_tokens = 0
+        self.output_tokens = 0
+        self.cost_usd = 0.0
+        self.latency_s = 0.0
+        self.outcomes: Dict[str, int] = {}
+        self.models: Dict[str, int] = {}
+
+    def add(self, usage: dict, latency: float, outcome: str) -> None:
+        self.requests += 1
+        self.calls += usage["calls"]
+        self.input_tokens += usage["input_tokens"]
+        self.cached_tokens += usage["cached_tokens"]
+        self.output_tokens += usage["output_tokens"]
+        self.cost_usd += usage["cost_usd"]
+        self.latency_s += latency
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        for model in usage["models"]:
+            self.models[model] = self.models.get(model, 0) + 1
+
+    def merge(self, other: "_Totals") -> None:
+        self.requests += other.requests
+        self.calls += other.calls
+        self.input_tokens += other.input_tokens
+        self.cached_tokens += other.cached_tokens
+        self.output_tokens += other.output_tokens
+        self.cost_usd += other.cost_usd
+        self.latency_s += other.latency_s
+        for outcome, count in other.outcomes.items():
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + count
+        for model, count in other.models.items():
+            self.models[model] = self.models.get(model, 0) + count
+
+    def summary(self) -> dict:
+        requests = max(self.requests, 1)
+        return {
+            "requests": self.requests,
+            "outcomes": dict(self.outcomes),
+            "calls": self.calls,
+            "input_tokens": self.input_tokens,
+            "cached_tokens": self.cached_tokens,
+            "output_tokens": self.output_tokens,
+            "cached_share": round(self.cached_tokens / self.input_tokens, 4) if self.input_tokens else 0.0,
+            "cost_usd": round(self.cost_usd, 6),
+            "avg_cost_usd": round(self.cost_usd / requests, 8),
+            "avg_latency_s": round(self.latency_s / requests, 4),
+            "models": dict(self.models),
+        }
+
+
+def _latency_fit(samples: Deque[Tuple[int, float]]) -> dict:
+    """Correlation of latency with output tokens and the seconds each 1k tokens add."""
+    n = len(samples)
+    if n < 2:
+        return {"samples": n}
+    mean_t = sum(t for t, _ in samples) / n
+    mean_l = sum(l for _, l in samples) / n
+    cov = sum((t - mean_t) * (l - mean_l) for t, l in samples)
+    var_t = sum((t - mean_t) ** 2 for t, _ in samples)
+    var_l = sum((l - mean_l) ** 2 for _, l in samples)
+    if not var_t or not var_l:
+        return {"samples": n}
+    return {
+        "samples": n,
+        "correlation": round(cov / (var_t * var_l) ** 0.5, 3),
+        "s_per_1k_output_tokens": round(cov / var_t * 1000, 3),
+    }
+
+
+class UsageLedger:
+    """Rolling usage totals per endpoint and tenant; also a pipeline hook."""
+
+    def __init__(self, tenant_key: str = "school", top_n: int = 20, samples: int = 1000,
+                 max_tenants: int = 1000):
+        self.tenant_key = tenant_key
+        self.top_n = top_n
+        self.samples = samples
+        self.max_tenants = max_tenants
+        self.endpoints: Dict[str, _Totals] = {}
+        # Least recently active first; evicted tenants are added to `other`
+        self.tenants: "OrderedDict[str, _Totals]" = OrderedDict()
+        self.other = _Totals()
+        self.latency: Dict[str, Deque[Tuple[int, float]]] = {}
+        self._costliest: List[Tuple[Tuple[float, int], int, dict]] = []
+        self._seq = itertools.count()
+
+    def record(self, endpoint: str, tenant: str, usage: dict, latency: float, outcome: str,
+               request_id: Optional[str] = None) -> None:
+        self.endpoints.setdefault(endpoint, _Totals()).add(usage, latency, outcome)
+        self._tenant(tenant).add(usage, latency, outcome)
+        if usage["calls"]:
+            self.latency.setdefault(endpoint, deque(maxlen=self.samples)).append(
+                (usage["output_tokens"], latency)
+            )
+
+        # Min-heap of the top_n most expensive requests (tokens break ties when unpriced)
+        rank = (usage["cost_usd"], usage["input_tokens"] + usage["output_tokens"])
+        entry = {
+            "request_id": request_id,
+            "endpoint": endpoint,
+            "tenant": tenant,
+            "outcome": outcome,
+            "at": time.time(),
+            "latency_s": round(latency, 3),
+            **usage,
+        }
+        item = (rank, next(self._seq), entry)
+        if len(self._costliest) < self.top_n:
+            heapq.heappush(self._costliest, item)
+        elif rank > self._costliest[0][0]:
+            heapq.heapreplace(self._costliest, item)
+
+    def _tenant(self, tenant: str) -> _Totals:
+        totals = self.tenants.get(tenant)
+        if totals is not None:
+            self.tenants.move_to_end(tenant)
+            return totals
+        totals = self.tenants[tenant] = _Totals()
+        if len(self.tenants) > self.max_tenants:
+            _, evicted = self.tenants.popitem(last=False)
+            self.other.merge(evicted)
+        return totals
+
+    # Pipeline hook
+    def on_stage(self, pipeline: str, stage: str, elapsed: float) -> None:
+        pass
+
+    def on_finish(self, pipeline: str, ctx, outcome: str) -> None:
+        if ctx.usage is None:
+            return
+        tenant = ctx.tenant or (tenant_of(ctx.student, self.tenant_key) if ctx.student is not None else "unknown")
+        self.record(ctx.endpoint, tenant, ctx.usage.summary(), time.perf_counter() - ctx.started,
+                    outcome, ctx.request_id)
+
+    def summary(self) -> dict:
+        return {
+            "endpoints": {
+                endpoint: {**totals.summary(), "latency_vs_tokens": _latency_fit(self.latency.get(endpoint, ()))}
+                for endpoint, totals in self.endpoints.items()
+            },
+            "tenants": {tenant: totals.summary() for tenant, totals in self.tenants.items()},
+            "other_tenants": self.other.summary(),
+            "costliest": [entry for _, _, entry in sorted(self._costliest, reverse=True)],
+        }
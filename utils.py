@@ -1,7 +1,9 @@
 from pydantic import BaseModel
-from typing import Optional
-from models import StudentInfo
+from typing import Optional, List, Tuple
+from models import StudentInfo, PersonaAnalysis, PersonaDraft, LearningMethod
 from datetime import datetime
+import hashlib
+import re
 
 def student_text(c: StudentInfo) -> str:
     """
@@ -54,6 +56,34 @@ def student_text(c: StudentInfo) -> str:
     return paragraph
 
 
+def canonical_student(c: StudentInfo) -> StudentInfo:
+    """
+    Normalise a profile so that equivalent submissions compare equal:
+    surrounding whitespace is stripped and subjects are de-duplicated
+    (keeping their original order).
+    """
+    subjects = []
+    for subject in c.favourite_subjects:
+        subject = subject.strip()
+        if subject and subject not in subjects:
+            subjects.append(subject)
+
+    return StudentInfo(
+        name=c.name.strip(),
+        gender=c.gender.strip(),
+        form=c.form.strip(),
+        school=c.school.strip(),
+        preferred_language=c.preferred_language.strip(),
+        favourite_subjects=subjects,
+        study_frequency=c.study_frequency.strip()
+    )
+
+
+def profile_key(c: StudentInfo) -> str:
+    """Stable key for a canonical profile, used for caching and dedupe."""
+    return hashlib.sha256(c.model_dump_json().encode("utf-8")).hexdigest()
+
+
 def create_persona_prompt(text_summary: str) -> str:
     return f"""
         You are an expert tutor creating a student persona to assess education needs.
@@ -71,6 +101,139 @@ def create_persona_prompt(text_summary: str) -> str:
         Think through this step-by-step before providing the final structured output.
         """
 
+def create_persona_draft_prompt(text_summary: str) -> str:
+    """
+    Reduced version of create_persona_prompt for structured output: the
+    language rule and the method list are applied in Python (see
+    build_persona_analysis), so the model only writes the free text.
+    """
+    return f"""
+        You are an expert tutor creating a student persona to assess education needs.
+
+        Student Information: {text_summary}
+
+        ### INSTRUCTIONS:
+        1. Analyze the student's profile (subjects, age, gender) to infer their personality, study preferences, and life vision, and describe it in one concise paragraph.
+        2. For each of the 6 learning methods (Feynman Technique, Mnemonics, Visualisation, Contextual Learning, Key Points, Spaced Repetition), give a short rationale for this student and a specific example related to their subjects.
+        """
+
+
+def create_fanout_prompt(text_summary: str, section: str) -> str:
+    """
+    Prompt for one fan-out section ("persona" or a LEARNING_METHODS key).
+    Everything before the TASK line is identical across a request's
+    sections so the provider can reuse the cached prompt prefix.
+    """
+    if section == "persona":
+        task = "Describe the student's personality, study preferences, and life vision in one concise paragraph."
+    else:
+        method_name = next(m["method_name"] for m in LEARNING_METHODS if m["key"] == section)
+        task = (
+            f"For the {method_name} learning method, give a short rationale for this student "
+            f"and a specific example related to their subjects."
+        )
+    return f"""
+        You are an expert tutor creating a student persona to assess education needs.
+        The persona is written in sections; you will be asked for one section only.
+
+        Student Information: {text_summary}
+
+        ### TASK:
+        {task}
+        """
+
+
+def create_class_persona_prompt(summaries: List[Tuple[str, str]]) -> str:
+    """
+    Same instructions as create_persona_draft_prompt, given once for a group
+    of students. summaries holds (student_id, text_summary) pairs.
+    """
+    students = "\n".join(
+        f"        - [{student_id}] {text_summary}" for student_id, text_summary in summaries
+    )
+    return f"""
+        You are an expert tutor creating student personas to assess education needs.
+        You will analyse {len(summaries)} students independently of each other.
+
+        Students (id in brackets):
+{students}
+
+        ### INSTRUCTIONS (apply to each student separately):
+        1. Analyze the student's profile (subjects, age, gender) to infer their personality, study preferences, and life vision, and describe it in one concise paragraph.
+        2. For each of the 6 learning methods (Feynman Technique, Mnemonics, Visualisation, Contextual Learning, Key Points, Spaced Repetition), give a short rationale for this student and a specific example related to their subjects.
+
+        Return exactly one entry per student, using the student's id as student_id.
+        """
+
+
+# ----------------------
+# Locally derived persona fields
+# ----------------------
+# The six recommended methods, in display order. "key" matches the field
+# name in PersonaDraft.
+LEARNING_METHODS = [
+    {"key": "feynman", "method_name": "Feynman Technique", "icon": "🧠"},
+    {"key": "mnemonic", "method_name": "Mnemonics", "icon": "🧩"},
+    {"key": "visualisation", "method_name": "Visualisation", "icon": "🎨"},
+    {"key": "contextual", "method_name": "Contextual Learning", "icon": "🌏"},
+    {"key": "key_points", "method_name": "Key Points", "icon": "📌"},
+    {"key": "spaced_repetition", "method_name": "Spaced Repetition", "icon": "🔁"},
+]
+
+# Patronymics and common given names that mark a Malay name
+MALAY_NAME_MARKERS = {
+    "bin", "binti", "bt", "bte", "b.", "bt.",
+    "muhammad", "muhammed", "mohd", "mohamad", "mohammad", "mohamed", "muhd", "md",
+    "ahmad", "abdul", "abd", "nur", "nurul", "noor", "siti", "wan", "nik", "syed",
+    "sharifah", "tengku", "tunku", "megat", "puteri", "raja", "awang", "dayang",
+}
+
+
+def is_malay_name(name: str) -> bool:
+    return any(part in MALAY_NAME_MARKERS for part in name.lower().split())
+
+
+def is_smk(school: str) -> bool:
+    """
+    Whether a free-text school name is a national secondary school: "SMK",
+    "S.M.K.", "SMK(P)", "SMKA" ... or "Sekolah Menengah Kebangsaan" spelled out.
+    """
+    words = re.sub(r"[^a-z0-9]+", " ", school.lower().replace(".", "")).split()
+    return any(word.startswith("smk") for word in words) or "sekolah menengah kebangsaan" in " ".join(words)
+
+
+def infer_language_preference(c: StudentInfo) -> str:
+    """
+    The rule from create_persona_prompt: a Malay name studying in an SMK
+    means Malay is the studying language. Otherwise Malay is not the primary
+    language, so the student's own preference is used (English if that
+    preference is Malay).
+    """
+    if is_malay_name(c.name) and is_smk(c.school):
+        return "Malay"
+    if c.preferred_language and c.preferred_language.lower() != "malay":
+        return c.preferred_language
+    return "English"
+
+
+def build_persona_analysis(c: StudentInfo, draft: PersonaDraft) -> PersonaAnalysis:
+    """Merge the model's draft with the locally derived fields."""
+    return PersonaAnalysis(
+        # Not rendered anywhere and no longer generated
+        thinking_process="",
+        student_persona=draft.student_persona,
+        language_preference=infer_language_preference(c),
+        learning_methods=[
+            LearningMethod(
+                method_name=method["method_name"],
+                icon=method["icon"],
+                rationale=getattr(draft, method["key"]).rationale,
+                example=getattr(draft, method["key"]).example
+            )
+            for method in LEARNING_METHODS
+        ]
+    )
+
 # List of subjects for the form
 SUBJECTS_LIST = [
     {"id": "bahasamelayu", "label": "Bahasa Melayu", "value": "Bahasa Melayu"},